@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from django.contrib.messages import constants as messages
 
@@ -87,6 +88,32 @@ DATABASES = {
     }
 }
 
+# Journal mode set on every new SQLite connection (e.g. 'wal'), handy when
+# comparing configurations with `manage.py loadtest`. None keeps the default.
+SQLITE_JOURNAL_MODE = os.environ.get('EXPENSEDIARY_SQLITE_JOURNAL_MODE')
+
+# Coalesce concurrent expense inserts into one transaction per batch
+# (see expenses/writes.py). A batch is flushed once it holds
+# EXPENSE_WRITE_BATCH_SIZE expenses or EXPENSE_WRITE_BATCH_DELAY seconds
+# after the first one arrived, whichever comes first.
+EXPENSE_WRITE_BATCHING = os.environ.get('EXPENSEDIARY_WRITE_BATCHING') == '1'
+EXPENSE_WRITE_BATCH_SIZE = 64
+EXPENSE_WRITE_BATCH_DELAY = 0.005
+
+# File holding the month and day totals shared by all workers of a host
+# (see expenses/sharedstats.py), e.g. '/dev/shm/expensediary.stats'.
+# None reads them from the database in every worker. Writes made by a
+# process without this setting only show up after the workers restart.
+EXPENSE_SHARED_STATS_PATH = os.environ.get('EXPENSEDIARY_SHARED_STATS_PATH')
+
+# Bearer token the batch API (POST /api/expenses/batch/) requires in the
+# Authorization header. None leaves the API open to anybody who can reach
+# the server.
+EXPENSE_API_TOKEN = os.environ.get('EXPENSEDIARY_API_TOKEN')
+
+# Default directory of `manage.py backup` snapshots
+BACKUP_DIR = BASE_DIR / 'backups'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -1,6 +1,169 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Sum
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
 
 # Register your models here.
-from .models import Expense
+from . import stats
+from .models import Expense, MonthlyStat
 
-admin.site.register(Expense)
\ No newline at end of file
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Takes the number of expenses from the monthly statistics instead of
+    running COUNT(*) over the whole table when nothing is filtered.
+    """
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            return MonthlyStat.objects.aggregate(
+                count=Sum('count'))['count'] or 0
+        return super().count
+
+
+class MonthListFilter(admin.SimpleListFilter):
+    """
+    Month picker built from the monthly statistics, so listing the choices
+    does not scan the expenses like the built-in date_hierarchy does.
+    """
+    title = 'month'
+    parameter_name = 'month'
+
+    def lookups(self, request, model_admin):
+        months = MonthlyStat.objects.filter(count__gt=0).order_by(
+            '-year', '-month')
+        return [('%d-%d' % (stat.year, stat.month),
+                 '%d/%02d (%d)' % (stat.year, stat.month, stat.count))
+                for stat in months]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            year, month = (int(part) for part in self.value().split('-'))
+            return queryset.in_month(year, month)
+        except ValueError:
+            return queryset.none()
+
+
+def affected_months(queryset):
+    return {(moment.year, moment.month)
+            for moment in queryset.order_by().datetimes(
+                'payment_time', 'month')}
+
+
+class ExpenseAdminForm(forms.ModelForm):
+    """
+    Carries the version the expense had when the form was opened, so an
+    edit made by someone else in the meantime is not silently overwritten.
+    """
+    loaded_version = forms.IntegerField(widget=forms.HiddenInput,
+                                        required=False)
+
+    class Meta:
+        model = Expense
+        exclude = ('version', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.fields['loaded_version'].initial = self.instance.version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.instance.pk is not None:
+            current = Expense.objects.select_for_update().filter(
+                pk=self.instance.pk).values_list('version', flat=True).first()
+            if current != cleaned_data.get('loaded_version'):
+                raise ValidationError(
+                    'This expense was changed by someone else in the '
+                    'meantime, please reload it and try again.')
+        return cleaned_data
+
+
+@admin.register(Expense)
+class ExpenseAdmin(admin.ModelAdmin):
+    form = ExpenseAdminForm
+    list_display = ('id', 'title', 'amount', 'payment_time')
+    list_display_links = ('id', 'title')
+    list_filter = (MonthListFilter, )
+    # payment_time is indexed and SQLite indexes carry the rowid, so this
+    # ordering is served straight from the index
+    ordering = ('-payment_time', '-id')
+    readonly_fields = ('version', )
+    list_per_page = 50
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    actions = ['delete_expenses', 'recalculate_monthly_stats']
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # the stock action loads and deletes the rows one by one
+        actions.pop('delete_selected', None)
+        return actions
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            # makes forms opened before this edit conflict on submit
+            obj.version += 1
+        super().save_model(request, obj, form, change)
+
+    def delete_expenses(self, request, queryset):
+        months = sorted(affected_months(queryset))
+
+        if request.POST.get('post') != 'yes':
+            # ask first, like the stock delete_selected action does
+            select_across = request.POST.get('select_across') == '1'
+            return TemplateResponse(
+                request,
+                'admin/expenses/expense/delete_expenses_confirmation.html', {
+                    **self.admin_site.each_context(request),
+                    'title': 'Are you sure?',
+                    'opts': self.model._meta,
+                    'count': queryset.count(),
+                    'months': months,
+                    'select_across': select_across,
+                    'selected': [] if select_across else
+                    queryset.values_list('pk', flat=True),
+                    'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+                })
+
+        with transaction.atomic():
+            # a single DELETE, without loading rows or sending signals
+            deleted = queryset._raw_delete(queryset.db)
+
+            for year, month in months:
+                stats.rebuild_month(year, month)
+
+        self.message_user(request, 'Deleted %d expenses.' % deleted,
+                          messages.SUCCESS)
+
+    delete_expenses.short_description = 'Delete selected expenses'
+    delete_expenses.allowed_permissions = ('delete', )
+
+    def recalculate_monthly_stats(self, request, queryset):
+        months = affected_months(queryset)
+
+        with transaction.atomic():
+            for year, month in months:
+                stats.rebuild_month(year, month)
+
+        self.message_user(request,
+                          'Recalculated statistics of %d months.' %
+                          len(months), messages.SUCCESS)
+
+    recalculate_monthly_stats.short_description = (
+        'Recalculate monthly statistics of selected expenses')
+    recalculate_monthly_stats.allowed_permissions = ('change', )
+
+
+@admin.register(MonthlyStat)
+class MonthlyStatAdmin(admin.ModelAdmin):
+    list_display = ('year', 'month', 'total', 'count')
+    list_filter = ('year', )
+    ordering = ('-year', '-month')
@@ -1,5 +1,24 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+
+
+def set_journal_mode(sender, connection, **kwargs):
+    mode = settings.SQLITE_JOURNAL_MODE
+    if connection.vendor == 'sqlite' and mode:
+        if mode.lower() not in JOURNAL_MODES:
+            raise ImproperlyConfigured('Unknown SQLITE_JOURNAL_MODE: %s' % mode)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = %s' % mode)
 
 
 class ExpensesConfig(AppConfig):
     name = 'expenses'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        connection_created.connect(set_journal_mode)
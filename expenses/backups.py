@@ -0,0 +1,245 @@
+"""
+Online snapshots of the SQLite database, used by the backup and restore
+management commands.
+
+Snapshots are taken with SQLite's backup API a few pages at a time,
+pausing between steps, so the app's own writes are never blocked for
+long. They are stored gzip compressed next to a sha256sum-style checksum
+file and a manifest summarizing what was copied, so a snapshot can be
+verified on its own long after the live database moved on.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .stats import month_of
+
+PREFIX = 'expenses-'
+SUFFIX = '.sqlite3.gz'
+
+
+def live_connection():
+    """
+    The raw sqlite3 connection of the default database.
+    """
+    if connection.vendor != 'sqlite':
+        raise CommandError('Backups are only supported for SQLite.')
+    connection.ensure_connection()
+    return connection.connection
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def copy_online(source, target, pages, pause, max_restarts=3):
+    """
+    Copy `source` into `target` `pages` at a time. SQLite starts a paged
+    copy over whenever another connection writes to the source, so under
+    steady writes it would never finish: after `max_restarts` restarts the
+    rest is copied in a single step, i.e. under one read transaction.
+    Returns the number of restarts seen.
+    """
+    seen = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        # every step copies pages, so a step that did not bring `remaining`
+        # down started over
+        if seen['remaining'] is not None and remaining >= seen['remaining']:
+            seen['restarts'] += 1
+            if seen['restarts'] > max_restarts:
+                raise TooManyRestarts()
+        seen['remaining'] = remaining
+        # let the app's writers in between two steps
+        if remaining and pause:
+            time.sleep(pause)
+
+    if pages > 0:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+            return seen['restarts']
+        except TooManyRestarts:
+            pass
+
+    source.backup(target, pages=-1)
+    return seen['restarts']
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum_path(path):
+    return path + '.sha256'
+
+
+def manifest_path(path):
+    return path + '.manifest.json'
+
+
+def read_manifest(path):
+    try:
+        with open(manifest_path(path)) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        raise CommandError('No manifest found for %s' % path)
+
+
+def verify_checksum(path):
+    try:
+        with open(checksum_path(path)) as handle:
+            expected = handle.read().split()[0]
+    except (OSError, IndexError):
+        raise CommandError('No checksum found for %s' % path)
+    if checksum(path) != expected:
+        raise CommandError('Checksum mismatch, %s is corrupt' % path)
+
+
+def quick_check(database):
+    result = database.execute('PRAGMA quick_check').fetchone()[0]
+    if result != 'ok':
+        raise CommandError('Integrity check failed: %s' % result)
+
+
+def create_snapshot(directory, pages=64, pause=0.005, max_restarts=3):
+    """
+    Snapshot the live database into `directory`, returns the file name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.join(
+        directory,
+        PREFIX + timezone.now().strftime('%Y%m%d-%H%M%S-%f') + SUFFIX)
+
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        raw_path = os.path.join(workdir, 'snapshot.sqlite3')
+        target = sqlite3.connect(raw_path)
+        try:
+            copy_online(live_connection(), target, pages, pause,
+                        max_restarts)
+            quick_check(target)
+            summary = summarize(target)
+        finally:
+            target.close()
+
+        compressed = os.path.join(workdir, 'snapshot.gz')
+        with open(raw_path, 'rb') as raw, gzip.open(compressed, 'wb') as gz:
+            shutil.copyfileobj(raw, gz)
+
+        with open(manifest_path(compressed), 'w') as handle:
+            json.dump(summary, handle, indent=2, sort_keys=True)
+        with open(checksum_path(compressed), 'w') as handle:
+            handle.write('%s  %s\n' %
+                         (checksum(compressed), os.path.basename(name)))
+        # the snapshot itself last: once it shows up, so did the rest
+        os.replace(manifest_path(compressed), manifest_path(name))
+        os.replace(checksum_path(compressed), checksum_path(name))
+        os.replace(compressed, name)
+
+    return name
+
+
+def snapshots(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(PREFIX) and name.endswith(SUFFIX))
+
+
+def rotate(directory, keep):
+    """
+    Delete all but the `keep` newest snapshots, returns the deleted ones.
+    """
+    old = snapshots(directory)[:-keep] if keep else []
+    for path in old:
+        os.remove(path)
+        for companion in (checksum_path(path), manifest_path(path)):
+            if os.path.exists(companion):
+                os.remove(companion)
+    return old
+
+
+class open_snapshot:
+    """
+    Context manager decompressing a verified snapshot into a temporary
+    sqlite3 connection.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        verify_checksum(self.path)
+        self.workdir = tempfile.TemporaryDirectory()
+        raw_path = os.path.join(self.workdir.name, 'snapshot.sqlite3')
+        with gzip.open(self.path, 'rb') as gz, open(raw_path, 'wb') as raw:
+            shutil.copyfileobj(gz, raw)
+        self.database = sqlite3.connect(raw_path)
+        quick_check(self.database)
+        return self.database
+
+    def __exit__(self, *exc_info):
+        self.database.close()
+        self.workdir.cleanup()
+
+
+def summarize(database):
+    """
+    Row count of every table and expense count and total of every month.
+    """
+    tables = [
+        name for name, in database.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' ORDER BY name")
+    ]
+    counts = {
+        table: database.execute('SELECT COUNT(*) FROM "%s"' %
+                                table).fetchone()[0]
+        for table in tables
+    }
+    months = {}
+    if 'expenses_expense' in counts:
+        # the app's local time months (see stats.month_of), not SQLite's
+        # UTC ones, so the totals are the ones users see
+        # as text: Django's own connection would convert it, a plain one not
+        for payment_time, amount in database.execute(
+                'SELECT CAST(payment_time AS TEXT), amount '
+                'FROM expenses_expense'):
+            payment_time = timezone.make_aware(parse_datetime(payment_time),
+                                               timezone.utc)
+            month = months.setdefault('%d-%02d' % month_of(payment_time),
+                                      [0, 0.0])
+            month[0] += 1
+            month[1] += amount
+        for month in months.values():
+            month[1] = round(month[1], 2)
+    return {'tables': counts, 'months': months}
+
+
+def differences(expected, actual, expected_from, actual_from):
+    """
+    Human readable list of what differs between two summaries, taken
+    from the places named by `expected_from` and `actual_from`.
+    """
+    found = []
+    for kind in ('tables', 'months'):
+        for key in sorted(set(expected[kind]) | set(actual[kind])):
+            if expected[kind].get(key) != actual[kind].get(key):
+                found.append('%s %s: %s %s, %s %s' %
+                             (kind[:-1], key, expected[kind].get(key),
+                              expected_from, actual[kind].get(key),
+                              actual_from))
+    return found
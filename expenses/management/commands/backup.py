@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import backups
+
+
+class Command(BaseCommand):
+    help = ('Take an online, compressed and checksummed snapshot of the '
+            'database without stalling the app, or verify one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir',
+                            default=str(settings.BACKUP_DIR),
+                            help='Where snapshots are kept.')
+        parser.add_argument('--pages',
+                            type=int,
+                            default=64,
+                            help='Database pages copied per step.')
+        parser.add_argument('--pause',
+                            type=float,
+                            default=0.005,
+                            help='Seconds to wait between two steps.')
+        parser.add_argument('--max-restarts',
+                            type=int,
+                            default=3,
+                            help='Writes to the database restart a paged '
+                            'copy; after this many restarts the rest is '
+                            'copied in one step.')
+        parser.add_argument('--keep',
+                            type=int,
+                            default=7,
+                            help='Number of snapshots to keep (0 keeps '
+                            'all of them).')
+        parser.add_argument('--verify',
+                            metavar='SNAPSHOT',
+                            help='Instead of taking a snapshot, check '
+                            'that this one is intact and holds what was '
+                            'copied when it was taken.')
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            return self.verify(options['verify'])
+
+        if options['pages'] < 1:
+            raise CommandError('--pages must be at least 1')
+
+        path = backups.create_snapshot(options['dir'], options['pages'],
+                                       options['pause'],
+                                       options['max_restarts'])
+        self.stdout.write(self.style.SUCCESS('Snapshot written to %s' % path))
+
+        for old in backups.rotate(options['dir'], options['keep']):
+            self.stdout.write('Removed old snapshot %s' % old)
+
+    def verify(self, path):
+        expected = backups.read_manifest(path)
+        with backups.open_snapshot(path) as snapshot:
+            actual = backups.summarize(snapshot)
+
+        found = backups.differences(expected, actual, 'in the manifest',
+                                    'in the snapshot')
+        if found:
+            for difference in found:
+                self.stderr.write(difference)
+            raise CommandError('%s does not match its manifest.' % path)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                '%s matches its manifest (%d tables, %d months).' %
+                (path, len(expected['tables']), len(expected['months']))))
@@ -0,0 +1,370 @@
+import csv
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.client import HTTPException
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlparse
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from django.utils import timezone
+
+DEFAULT_MIX = 'index=40,chart=10,detail=25,add=15,update=10'
+
+CSRF_INPUT = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+DETAIL_LINK = re.compile(r'/expense/detail/(\d+)/')
+
+
+def percentile(sorted_values, q):
+    """
+    Nearest-rank percentile of an already sorted list, ``q`` in [0, 100].
+    """
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(q / 100.0 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in Command.endpoints:
+            raise CommandError('Unknown endpoint "%s" in --mix' % name)
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise CommandError('Invalid weight for "%s" in --mix' % name)
+    if not any(weights.values()):
+        raise CommandError('--mix needs at least one positive weight')
+    return weights
+
+
+def saved(status, location, form):
+    """
+    Whether a form POST went through: the views answer invalid input and
+    edit conflicts with a redirect too, but back to the form.
+    """
+    return status in (301, 302, 303) and location not in (None, form)
+
+
+class NoRedirect(HTTPRedirectHandler):
+    # a redirect after a POST is the answer we are timing, don't follow it
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Client:
+    """
+    One simulated user: keeps its own cookie jar and CSRF token.
+    """
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()),
+                                   NoRedirect())
+        self.csrf_token = None
+
+    def request(self, path, data=None):
+        """
+        (status, body, redirect target path) of a GET, or of a POST when
+        `data` is given.
+        """
+        body = urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(self.base_url + path,
+                                  data=body,
+                                  timeout=self.timeout) as response:
+                return response.status, response.read().decode(
+                    'utf-8', 'replace'), None
+        except HTTPError as error:
+            location = error.headers.get('Location')
+            if location is not None:
+                location = urlparse(location).path
+            return error.code, '', location
+
+    def token(self):
+        if self.csrf_token is None:
+            _, page, _ = self.request(reverse('expenses:add'))
+            match = CSRF_INPUT.search(page)
+            if match is None:
+                raise CommandError('Could not find a CSRF token on %s' %
+                                   reverse('expenses:add'))
+            self.csrf_token = match.group(1)
+        return self.csrf_token
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        rows = []
+        everything = []
+        total_errors = 0
+        for endpoint in sorted(self.samples):
+            latencies = sorted(self.samples[endpoint])
+            errors = self.errors.get(endpoint, 0)
+            everything.extend(latencies)
+            total_errors += errors
+            rows.append(self._row(endpoint, latencies, errors, elapsed))
+        rows.append(
+            self._row('all', sorted(everything), total_errors, elapsed))
+        return rows
+
+    @staticmethod
+    def _row(endpoint, latencies, errors, elapsed):
+        count = len(latencies)
+        return {
+            'endpoint': endpoint,
+            'requests': count,
+            'errors': errors,
+            'error_rate': errors / count if count else 0.0,
+            'throughput': count / elapsed if elapsed else 0.0,
+            'mean_ms': 1000 * sum(latencies) / count if count else 0.0,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p95_ms': 1000 * percentile(latencies, 95),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'max_ms': 1000 * latencies[-1] if latencies else 0.0,
+        }
+
+
+class Pacer:
+    """
+    Spreads requests of all workers evenly to hit a target rate.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Command(BaseCommand):
+    help = ('Drive a mixed, concurrent workload against a running server '
+            'and report throughput, latency percentiles and error rates '
+            'per endpoint.')
+
+    endpoints = ('index', 'chart', 'detail', 'add', 'update')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url',
+                            default='http://127.0.0.1:8000',
+                            help='Base URL of the server under test.')
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=8,
+                            help='Number of simulated users.')
+        parser.add_argument('--rate',
+                            type=float,
+                            default=0,
+                            help='Target requests per second over all '
+                            'users (0 means as fast as possible).')
+        parser.add_argument('--duration',
+                            type=float,
+                            default=30,
+                            help='Seconds to run for.')
+        parser.add_argument('--requests',
+                            type=int,
+                            default=0,
+                            help='Stop after this many requests instead '
+                            'of after --duration.')
+        parser.add_argument('--mix',
+                            default=DEFAULT_MIX,
+                            help='Relative weight of each endpoint, '
+                            'e.g. "%s".' % DEFAULT_MIX)
+        parser.add_argument('--seed-expenses',
+                            type=int,
+                            default=12,
+                            help='Expenses to add first when the current '
+                            'month has none to browse.')
+        parser.add_argument('--timeout', type=float, default=10)
+        parser.add_argument('--label',
+                            default='',
+                            help='Free-form tag stored with the results, '
+                            'e.g. "wal, 4 workers".')
+        parser.add_argument('--output',
+                            help='Write the results to a .json or .csv '
+                            'file.')
+
+    def handle(self, *args, **options):
+        weights = parse_mix(options['mix'])
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        now = timezone.localtime()
+        self.year, self.month = now.year, now.month
+        self.base_url = options['url']
+        self.timeout = options['timeout']
+
+        self.expense_ids = self.discover_expenses(options['seed_expenses'])
+        if not self.expense_ids:
+            weights.pop('detail', None)
+            weights.pop('update', None)
+        names = list(weights)
+        shares = [weights[name] for name in names]
+
+        recorder = Recorder()
+        pacer = Pacer(options['rate'])
+        budget = {'left': options['requests'] or None}
+        budget_lock = threading.Lock()
+        deadline = (None if options['requests'] else time.monotonic() +
+                    options['duration'])
+
+        def take_ticket():
+            if deadline is not None:
+                return time.monotonic() < deadline
+            with budget_lock:
+                if budget['left'] <= 0:
+                    return False
+                budget['left'] -= 1
+                return True
+
+        def worker(seed):
+            rng = random.Random(seed)
+            client = Client(self.base_url, self.timeout)
+            while take_ticket():
+                endpoint = rng.choices(names, weights=shares)[0]
+                pacer.wait()
+                started = time.perf_counter()
+                try:
+                    ok = getattr(self, 'hit_' + endpoint)(client, rng)
+                except (OSError, HTTPException, CommandError):
+                    # URLError is an OSError; a missing CSRF token or a
+                    # broken response must not end the thread unnoticed
+                    ok = False
+                recorder.record(endpoint, time.perf_counter() - started, ok)
+
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=worker, args=(n, ), daemon=True)
+            for n in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        rows = recorder.summary(elapsed)
+        self.print_report(rows, elapsed)
+
+        if options['output']:
+            self.export(options, rows, elapsed)
+
+    def discover_expenses(self, seed_count):
+        client = Client(self.base_url, self.timeout)
+        path = reverse('expenses:index', args=(self.year, self.month))
+        try:
+            status, page, _ = client.request(path)
+        except URLError as error:
+            raise CommandError('Could not reach %s: %s' %
+                               (self.base_url, error.reason))
+        ids = [int(i) for i in DETAIL_LINK.findall(page)]
+
+        if not ids and seed_count:
+            for n in range(seed_count):
+                self.hit_add(client, random.Random(n))
+            _, page, _ = client.request(path)
+            ids = [int(i) for i in DETAIL_LINK.findall(page)]
+
+        return sorted(set(ids))
+
+    def hit_index(self, client, rng):
+        path = reverse('expenses:index', args=(self.year, self.month))
+        status, _, _ = client.request('%s?page=%d' % (path, rng.randint(1, 3)))
+        return status < 400
+
+    def hit_chart(self, client, rng):
+        status, _, _ = client.request(
+            reverse('expenses:monthly_chart', args=(self.year, self.month)))
+        return status < 400
+
+    def hit_detail(self, client, rng):
+        status, _, _ = client.request(
+            reverse('expenses:detail', args=(rng.choice(self.expense_ids), )))
+        return status < 400
+
+    def hit_add(self, client, rng):
+        form = reverse('expenses:add')
+        status, _, location = client.request(
+            form, {
+                'csrfmiddlewaretoken': client.token(),
+                'title': 'load test %d' % rng.randint(1, 10**6),
+                'desc': 'generated by manage.py loadtest',
+                'price': rng.randint(1, 5000),
+            })
+        return saved(status, location, form)
+
+    def hit_update(self, client, rng):
+        form = reverse('expenses:update',
+                       args=(rng.choice(self.expense_ids), ))
+        status, _, location = client.request(
+            form, {
+                'csrfmiddlewaretoken': client.token(),
+                'price': rng.randint(1, 5000),
+            })
+        return saved(status, location, form)
+
+    def print_report(self, rows, elapsed):
+        self.stdout.write('Ran for %.1fs\n' % elapsed)
+        header = '%-8s %9s %7s %8s %10s %9s %9s %9s' % (
+            'endpoint', 'requests', 'errors', 'err %', 'req/s', 'p50 ms',
+            'p95 ms', 'p99 ms')
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in rows:
+            self.stdout.write('%-8s %9d %7d %7.2f%% %10.1f %9.1f %9.1f %9.1f' %
+                              (row['endpoint'], row['requests'],
+                               row['errors'], 100 * row['error_rate'],
+                               row['throughput'], row['p50_ms'],
+                               row['p95_ms'], row['p99_ms']))
+
+    def export(self, options, rows, elapsed):
+        path = options['output']
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as handle:
+                writer = csv.DictWriter(handle,
+                                        fieldnames=['label'] + list(rows[0]))
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(dict(row, label=options['label']))
+        else:
+            with open(path, 'w') as handle:
+                json.dump(
+                    {
+                        'label': options['label'],
+                        'url': options['url'],
+                        'concurrency': options['concurrency'],
+                        'rate': options['rate'],
+                        'mix': options['mix'],
+                        'elapsed': elapsed,
+                        'endpoints': rows,
+                    },
+                    handle,
+                    indent=2)
+        self.stdout.write(self.style.SUCCESS('Results written to %s' % path))
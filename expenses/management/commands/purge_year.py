@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expenses import stats
+from expenses.models import Expense, MonthlyStat
+
+
+class Command(BaseCommand):
+    help = 'Delete every expense of a year together with its statistics.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--noinput',
+                            '--no-input',
+                            action='store_false',
+                            dest='interactive',
+                            help='Do not ask for confirmation.')
+
+    def handle(self, *args, **options):
+        year = options['year']
+
+        if options['interactive']:
+            answer = input('This deletes all expenses of %d for good. '
+                           'Type "yes" to continue: ' % year)
+            if answer != 'yes':
+                raise CommandError('Purge cancelled.')
+
+        expenses = Expense.objects.in_year(year)
+        with transaction.atomic():
+            # one ranged DELETE over the payment_time index, no per-row
+            # signals; the year's statistics go away with it
+            deleted = expenses._raw_delete(expenses.db)
+            MonthlyStat.objects.filter(year=year).delete()
+            for month in range(1, 13):
+                stats.month_changed(year, month)
+
+        self.stdout.write(
+            self.style.SUCCESS('Deleted %d expenses of %d.' % (deleted, year)))
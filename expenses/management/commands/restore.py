@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import backups, sharedstats
+from expenses.models import MonthlyStat
+
+
+class Command(BaseCommand):
+    help = 'Replace the database with a snapshot taken by `backup`.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('snapshot')
+        parser.add_argument('--noinput',
+                            '--no-input',
+                            action='store_false',
+                            dest='interactive',
+                            help='Do not ask for confirmation.')
+
+    def handle(self, *args, **options):
+        path = options['snapshot']
+
+        if options['interactive']:
+            answer = input('This replaces ALL current data with %s. '
+                           'Type "yes" to continue: ' % path)
+            if answer != 'yes':
+                raise CommandError('Restore cancelled.')
+
+        months = set(MonthlyStat.objects.values_list('year', 'month'))
+
+        with backups.open_snapshot(path) as snapshot:
+            expected = backups.summarize(snapshot)
+            # in one go: nobody should see a half restored database
+            backups.copy_online(snapshot,
+                                backups.live_connection(),
+                                pages=-1,
+                                pause=0)
+
+        found = backups.differences(
+            expected, backups.summarize(backups.live_connection()),
+            'in the snapshot', 'restored')
+        if found:
+            raise CommandError('Restored database does not match %s: %s' %
+                               (path, '; '.join(found)))
+
+        # workers read month totals from the shared store, bring it in line
+        months |= set(MonthlyStat.objects.values_list('year', 'month'))
+        for year, month in months:
+            sharedstats.month_changed(year, month)
+
+        self.stdout.write(self.style.SUCCESS('Restored %s' % path))
@@ -0,0 +1,58 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:29
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def fill_monthly_stats(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    MonthlyStat = apps.get_model('expenses', 'MonthlyStat')
+
+    months = Expense.objects.order_by().annotate(
+        year=ExtractYear('payment_time'),
+        month=ExtractMonth('payment_time')).values('year', 'month').annotate(
+            total=Sum('amount'), count=Count('id'))
+
+    MonthlyStat.objects.bulk_create(
+        MonthlyStat(year=row['year'],
+                    month=row['month'],
+                    total=row['total'],
+                    count=row['count']) for row in months)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('total', models.FloatField(default=0)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['year', 'month'],
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='expense',
+            options={'ordering': ['-payment_time']},
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='payment_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddConstraint(
+            model_name='monthlystat',
+            constraint=models.UniqueConstraint(fields=('year', 'month'), name='unique_monthly_stat'),
+        ),
+        migrations.RunPython(fill_monthly_stats, migrations.RunPython.noop),
+    ]
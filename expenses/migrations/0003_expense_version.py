@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0002_monthly_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
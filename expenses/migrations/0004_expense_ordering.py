@@ -0,0 +1,17 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:31
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0003_expense_version'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='expense',
+            options={'ordering': ['-payment_time', '-id']},
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:32
+
+import json
+import math
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+class QuantileSketch:
+    # frozen copy of the bucketing and JSON format of
+    # expenses.sketches.QuantileSketch when this migration was written
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(gamma)
+        self.buckets = {}
+        self.zeros = 0
+
+    def add(self, amount):
+        amount = float(amount)
+        if amount <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(amount) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def to_json(self):
+        return json.dumps({
+            'accuracy': self.relative_accuracy,
+            'zeros': self.zeros,
+            'buckets': self.buckets,
+        })
+
+
+def fill_monthly_sketches(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    MonthlyStat = apps.get_model('expenses', 'MonthlyStat')
+
+    sketches = {}
+    for payment_time, amount in Expense.objects.order_by().values_list(
+            'payment_time', 'amount').iterator():
+        local_time = timezone.localtime(payment_time)
+        sketches.setdefault((local_time.year, local_time.month),
+                            QuantileSketch()).add(amount)
+
+    for (year, month), sketch in sketches.items():
+        MonthlyStat.objects.filter(year=year, month=month).update(
+            sketch=sketch.to_json())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0004_expense_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlystat',
+            name='sketch',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(fill_monthly_sketches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0005_monthly_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.4 on 2026-10-19 17:46
+
+import heapq
+import json
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# stats.LARGEST_KEPT when this migration was written
+LARGEST_KEPT = 5
+
+
+def fill_monthly_largest(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    MonthlyStat = apps.get_model('expenses', 'MonthlyStat')
+
+    months = {}
+    for expense_id, payment_time, amount in Expense.objects.order_by(
+    ).values_list('id', 'payment_time', 'amount').iterator():
+        local_time = timezone.localtime(payment_time)
+        largest = months.setdefault((local_time.year, local_time.month), [])
+        # keep a min-heap of the biggest (amount, id) seen so far
+        if len(largest) < LARGEST_KEPT:
+            heapq.heappush(largest, (amount, expense_id))
+        else:
+            heapq.heappushpop(largest, (amount, expense_id))
+
+    for (year, month), largest in months.items():
+        MonthlyStat.objects.filter(year=year, month=month).update(
+            largest=json.dumps([[expense_id, amount] for amount, expense_id
+                                in sorted(largest, reverse=True)]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0006_expense_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlystat',
+            name='largest',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(fill_monthly_largest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1.4 on 2026-10-19 18:03
+
+import json
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_monthly_days(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    MonthlyStat = apps.get_model('expenses', 'MonthlyStat')
+
+    months = {}
+    for payment_time, amount in Expense.objects.order_by().values_list(
+            'payment_time', 'amount').iterator():
+        local_time = timezone.localtime(payment_time)
+        days = months.setdefault((local_time.year, local_time.month),
+                                 [[0.0, 0] for _ in range(31)])
+        days[local_time.day - 1][0] += amount
+        days[local_time.day - 1][1] += 1
+
+    for (year, month), days in months.items():
+        MonthlyStat.objects.filter(year=year, month=month).update(
+            days=json.dumps([[round(total, 2), count]
+                             for total, count in days]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0007_monthly_largest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlystat',
+            name='days',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(fill_monthly_days, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,107 @@
 import datetime
+import json
+from collections import namedtuple
+
 from django.db import models
+from django.db.models.functions import Substr
+from django.db.models.query import ValuesListIterable
 from django.utils import timezone
 
+from .sketches import QuantileSketch
+
 # Create your models here.
 
 
+def month_start(year, month):
+    # months are those of the current time zone, like the __month lookup
+    return timezone.make_aware(datetime.datetime(year, month, 1))
+
+
+# what the list pages show of an expense; title and description are
+# cut one character past the 25 of `truncatechars`, so it still adds the '…'
+class ExpenseCard(
+        namedtuple('ExpenseCard',
+                   ['id', 'title', 'description', 'amount', 'payment_time'])):
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return str(self.amount)
+
+
+CARD_TEXT_LENGTH = 26
+
+
+class ExpenseCardIterable(ValuesListIterable):
+    def __iter__(self):
+        for row in super().__iter__():
+            yield ExpenseCard._make(row)
+
+
+class ExpenseQuerySet(models.QuerySet):
+    """
+    Month and year filters written as ranges on the indexed payment_time,
+    so a query only reads the index slice of the requested period instead
+    of extracting the month of every expense in the year (or table).
+    """
+    def in_month(self, year, month):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year,
+                                                                   month + 1)
+        return self.filter(payment_time__gte=month_start(year, month),
+                           payment_time__lt=month_start(next_year,
+                                                        next_month))
+
+    def in_year(self, year):
+        return self.filter(payment_time__gte=month_start(year, 1),
+                           payment_time__lt=month_start(year + 1, 1))
+
+    def listed_after(self, payment_time, expense_id):
+        """
+        Expenses coming after the given one in the (-payment_time, -id)
+        ordering, i.e. the next page of a keyset (cursor) pagination.
+        """
+        return self.filter(
+            models.Q(payment_time__lt=payment_time)
+            | models.Q(payment_time=payment_time, id__lt=expense_id))
+
+    def cards(self):
+        """
+        Only the columns the list pages render, as ExpenseCard tuples
+        instead of full model instances.
+        """
+        clone = self.annotate(
+            card_title=Substr('title', 1, CARD_TEXT_LENGTH),
+            card_description=Substr('description', 1, CARD_TEXT_LENGTH),
+        ).values_list('id', 'card_title', 'card_description', 'amount',
+                      'payment_time')
+        clone._iterable_class = ExpenseCardIterable
+        return clone
+
+
 class Expense(models.Model):
     title = models.CharField(max_length=100)
     description = models.CharField(max_length=200)
     amount = models.FloatField()
-    payment_time = models.DateTimeField()
+    payment_time = models.DateTimeField(db_index=True)
+    # bumped by every edit, see update_expense
+    version = models.PositiveIntegerField(default=0)
+    # set by API clients so a retried batch does not add the expense twice
+    idempotency_key = models.CharField(max_length=64,
+                                       unique=True,
+                                       null=True,
+                                       blank=True)
+
+    objects = ExpenseQuerySet.as_manager()
 
     def __str__(self) -> str:
         return str(self.amount)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so the monthly statistics can be corrected on save/delete
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def was_payed_recently(self):
         now = timezone.now()
 
@@ -24,5 +112,47 @@ class Expense(models.Model):
     class Meta:
         # ordering = ['-payment_time__day'] # do not have to use order_by (for daily aggregation)
         ordering = [
-            '-payment_time'
+            '-payment_time', '-id'
         ]  # descending order --> most recent first, have to use order_by (for daily aggregation)
+
+
+class MonthlyStat(models.Model):
+    """
+    Running total, number and amount distribution of the expenses of one
+    (local time) month, kept up to date by expenses/stats.py on every write.
+    """
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    total = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+    # QuantileSketch of the amounts, as JSON
+    sketch = models.TextField(blank=True, default='')
+    # the month's biggest expenses as JSON [[id, amount], ...], largest
+    # first, at most stats.LARGEST_KEPT of them
+    largest = models.TextField(blank=True, default='')
+    # [total, count] of each day of the month as JSON, 31 pairs
+    days = models.TextField(blank=True, default='')
+
+    def __str__(self) -> str:
+        return '%d/%d: %s' % (self.month, self.year, self.total)
+
+    def get_sketch(self):
+        return QuantileSketch.from_json(self.sketch)
+
+    def get_days(self):
+        if not self.days:
+            return [[0.0, 0] for _ in range(31)]
+        return json.loads(self.days)
+
+    def get_largest(self):
+        if not self.largest:
+            return []
+        return [(expense_id, amount)
+                for expense_id, amount in json.loads(self.largest)]
+
+    class Meta:
+        ordering = ['year', 'month']
+        constraints = [
+            models.UniqueConstraint(fields=['year', 'month'],
+                                    name='unique_monthly_stat'),
+        ]
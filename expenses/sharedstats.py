@@ -0,0 +1,263 @@
+"""
+Month and day totals shared by all worker processes of a host through a
+memory-mapped file, so that `index` and `monthly_chart` read them from
+memory instead of every worker querying (and caching) the same numbers.
+
+The file starts with a header, followed by a fixed array of one slot per
+month from FIRST_YEAR on:
+
+    header: magic | layout version | database identity | generation
+    slot:   sequence (uint64) | generation | total | count
+            | day 1 total ... day 31 total | day 1 count ... day 31 count
+
+Readers never lock. A slot is only trusted if its sequence number is the
+same, even and non-zero before and after reading it (a seqlock), and if
+it was written in the header's current generation for the database this
+process uses. Writers take an exclusive flock on the file, make the
+sequence odd, write, and make it even again. Slots are copied from the
+month's MonthlyStat row, which already holds the day totals, after every
+committed write (see stats.py) and on a read miss.
+
+Only processes with EXPENSE_SHARED_STATS_PATH set keep the file current.
+Every process that opens it starts a new generation, which drops all
+slots. A restart therefore also picks up writes made without the setting,
+e.g. from `manage.py shell` or a migration. A file left behind by another
+database or an older layout is reset as well.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX, the store stays disabled
+    fcntl = None
+
+from django.conf import settings
+from django.db import connection
+
+FIRST_YEAR = 2000
+YEARS = 100
+
+MAGIC = b'EXPSTATS'
+LAYOUT_VERSION = 3
+LAYOUT = struct.Struct('<8sI4x')
+HEADER = struct.Struct('<8sI4x32s')
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = HEADER.size
+HEADER_SIZE = 64
+
+SEQUENCE = struct.Struct('<Q')
+VALUES = struct.Struct('<Q64d')
+SLOT_SIZE = SEQUENCE.size + VALUES.size
+FILE_SIZE = HEADER_SIZE + YEARS * 12 * SLOT_SIZE
+
+MonthTotals = namedtuple('MonthTotals',
+                         ['total', 'count', 'days', 'day_counts'])
+
+
+def database_identity():
+    """
+    Digest telling apart the databases stores can be filled from.
+    """
+    database = connection.settings_dict
+    identity = [
+        connection.vendor,
+        str(database['NAME']),
+        database['HOST'],
+        database['PORT'],
+    ]
+    try:
+        # a SQLite file replaced by another one under the same name
+        stat = os.stat(database['NAME'])
+        identity += [stat.st_dev, stat.st_ino]
+    except (OSError, TypeError, ValueError):
+        pass
+    return hashlib.sha256(repr(identity).encode()).digest()
+
+
+class SharedMonthStore:
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.header = HEADER.pack(MAGIC, LAYOUT_VERSION, database_identity())
+        # per process descriptor: flock does not exclude processes that
+        # share a descriptor inherited through fork
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # and flock does not exclude the threads of one process either
+        self.thread_lock = threading.Lock()
+        with self.locked():
+            if os.fstat(self.fd).st_size < FILE_SIZE:
+                os.ftruncate(self.fd, FILE_SIZE)
+            self.map = mmap.mmap(self.fd, FILE_SIZE)
+            self._claim()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def locked(self):
+        return _FileLock(self.fd, self.thread_lock)
+
+    def _claim(self):
+        # under the lock: take over a file of another database or layout,
+        # with all its slots dropped
+        if self.map[:HEADER.size] == self.header:
+            return
+        if self.map[:LAYOUT.size] != self.header[:LAYOUT.size]:
+            # unknown layout, start from scratch
+            self.map[:] = bytes(FILE_SIZE)
+        # sequences keep counting up, so no reader can mistake a slot
+        # rewritten since it looked at it for the one it saw
+        generation, = GENERATION.unpack_from(self.map, GENERATION_OFFSET)
+        self.map[:HEADER.size] = self.header
+        GENERATION.pack_into(self.map, GENERATION_OFFSET, generation + 1)
+
+    def clear(self):
+        """
+        Drop every slot by starting a new generation; they are filled again
+        from the database on their next read.
+        """
+        with self.locked():
+            self._claim()
+            generation, = GENERATION.unpack_from(self.map, GENERATION_OFFSET)
+            GENERATION.pack_into(self.map, GENERATION_OFFSET, generation + 1)
+
+    def _generation(self):
+        """
+        Generation slots must have been written in, None when another
+        database took the file over.
+        """
+        if self.map[:HEADER.size] != self.header:
+            return None
+        generation, = GENERATION.unpack_from(self.map, GENERATION_OFFSET)
+        return generation
+
+    @staticmethod
+    def offset(year, month):
+        if not FIRST_YEAR <= year < FIRST_YEAR + YEARS or not 1 <= month <= 12:
+            return None
+        return HEADER_SIZE + ((year - FIRST_YEAR) * 12 + month - 1) * SLOT_SIZE
+
+    def read(self, year, month, retries=10):
+        """
+        MonthTotals of a month, or None when the slot was never written
+        (or kept changing under us).
+        """
+        offset = self.offset(year, month)
+        if offset is None:
+            return None
+
+        generation = self._generation()
+        if generation is None:
+            return None
+
+        for _ in range(retries):
+            before, = SEQUENCE.unpack_from(self.map, offset)
+            if before == 0:
+                return None
+            if before % 2:
+                continue
+            values = VALUES.unpack_from(self.map, offset + SEQUENCE.size)
+            after, = SEQUENCE.unpack_from(self.map, offset)
+            if before == after:
+                if values[0] != generation:
+                    return None
+                return MonthTotals(values[1], int(values[2]),
+                                   values[3:34],
+                                   tuple(int(count)
+                                         for count in values[34:]))
+        return None
+
+    def _write(self, offset, totals):
+        sequence, = SEQUENCE.unpack_from(self.map, offset)
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+        VALUES.pack_into(self.map, offset + SEQUENCE.size,
+                         self._generation(), totals.total, totals.count,
+                         *totals.days, *totals.day_counts)
+        SEQUENCE.pack_into(self.map, offset, sequence + 2)
+
+    def refresh(self, year, month):
+        """
+        Copy a month's totals from its statistics into its slot. The row is
+        read under the lock, so the last refresh to run always stores the
+        latest committed numbers.
+        """
+        from .models import MonthlyStat
+
+        offset = self.offset(year, month)
+        if offset is None:
+            return None
+
+        with self.locked():
+            self._claim()
+            stat = MonthlyStat.objects.filter(year=year, month=month).first()
+            days = stat.get_days() if stat else [[0.0, 0]] * 31
+            totals = MonthTotals(stat.total if stat else 0.0,
+                                 stat.count if stat else 0,
+                                 tuple(total for total, _ in days),
+                                 tuple(count for _, count in days))
+            self._write(offset, totals)
+        return totals
+
+
+class _FileLock:
+    def __init__(self, fd, thread_lock):
+        self.fd = fd
+        self.thread_lock = thread_lock
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    This process' SharedMonthStore, None unless EXPENSE_SHARED_STATS_PATH
+    is set. The first one a process opens starts out empty.
+    """
+    global _store
+
+    path = settings.EXPENSE_SHARED_STATS_PATH
+    if not path or fcntl is None:
+        return None
+
+    with _store_lock:
+        if _store is not None and _store.pid == os.getpid(
+        ) and _store.path != path:
+            _store.close()
+            _store = None
+        if _store is None or _store.pid != os.getpid():
+            _store = SharedMonthStore(path)
+            # whatever was written while no process kept the file current
+            # (e.g. by a migration) is not in it
+            _store.clear()
+        return _store
+
+
+def month_totals(year, month):
+    """
+    MonthTotals from the shared store, filling its slot on a miss; None
+    when the store is disabled or the month is out of its range.
+    """
+    store = get_store()
+    if store is None:
+        return None
+    return store.read(year, month) or store.refresh(year, month)
+
+
+def month_changed(year, month):
+    store = get_store()
+    if store is not None:
+        store.refresh(year, month)
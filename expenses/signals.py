@@ -0,0 +1,47 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import stats
+from .models import Expense
+
+TRACKED = ('payment_time', 'amount')
+
+
+def _loaded(instance):
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    if all(field in loaded for field in TRACKED):
+        return loaded
+    return None
+
+
+@receiver(post_save, sender=Expense)
+def expense_saved(sender, instance, created, **kwargs):
+    loaded = _loaded(instance)
+
+    if created:
+        stats.expense_added(instance.pk, instance.payment_time,
+                            instance.amount)
+    elif loaded is None:
+        # previous values unknown, recount the month from scratch
+        stats.rebuild_month(*stats.month_of(instance.payment_time))
+    elif (loaded['payment_time'] != instance.payment_time
+          or loaded['amount'] != float(instance.amount)):
+        stats.expense_removed(instance.pk, loaded['payment_time'],
+                              loaded['amount'])
+        stats.expense_added(instance.pk, instance.payment_time,
+                            instance.amount)
+
+    instance._loaded_values = {
+        'payment_time': instance.payment_time,
+        'amount': float(instance.amount),
+    }
+
+
+@receiver(post_delete, sender=Expense)
+def expense_deleted(sender, instance, **kwargs):
+    loaded = _loaded(instance) or {
+        'payment_time': instance.payment_time,
+        'amount': instance.amount,
+    }
+    stats.expense_removed(instance.pk, loaded['payment_time'],
+                          loaded['amount'])
@@ -0,0 +1,111 @@
+import json
+import math
+
+
+class QuantileSketch:
+    """
+    Log-bucketed histogram of amounts, in the spirit of DDSketch.
+
+    Every amount falls in the bucket ``ceil(log(amount, gamma))``, so any
+    quantile read back is within ``relative_accuracy`` of the true value.
+    Sketches merge by adding up bucket counts and, unlike t-digest or KLL,
+    an amount can be taken out again when an expense is edited or deleted.
+    The number of buckets only depends on the spread of the amounts (about
+    1400 cover 1 to 10^12 at 1%), not on how many there are.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.buckets.values())
+
+    def _key(self, amount):
+        return math.ceil(math.log(amount) / self.log_gamma)
+
+    def _value(self, key):
+        # middle of the bucket, relative error below relative_accuracy
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def add(self, amount, count=1):
+        amount = float(amount)
+        if amount <= 0:
+            self.zeros += count
+            return
+        key = self._key(amount)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        if self.buckets[key] <= 0:
+            del self.buckets[key]
+
+    def remove(self, amount, count=1):
+        self.add(amount, -count)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches of different accuracy')
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate amount below which a fraction `q` of the amounts lie,
+        None for an empty sketch.
+        """
+        total = self.count
+        if total <= 0:
+            return None
+
+        rank = q * (total - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return self._value(key)
+        return self._value(max(self.buckets))
+
+    def histogram(self, bins=10):
+        """
+        List of (low, high, count) covering the amounts in equal-width bins.
+        """
+        if self.count <= 0:
+            return []
+
+        values = [(0.0, self.zeros)] if self.zeros else []
+        values += [(self._value(key), count)
+                   for key, count in sorted(self.buckets.items())]
+        low, high = values[0][0], values[-1][0]
+        width = (high - low) / bins or 1
+
+        counts = [0] * bins
+        for value, count in values:
+            counts[min(int((value - low) / width), bins - 1)] += count
+        return [(low + n * width, low + (n + 1) * width, counts[n])
+                for n in range(bins)]
+
+    def to_json(self):
+        return json.dumps({
+            'accuracy': self.relative_accuracy,
+            'zeros': self.zeros,
+            'buckets': self.buckets,
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            return cls()
+        data = json.loads(data)
+        sketch = cls(data['accuracy'])
+        sketch.zeros = data['zeros']
+        sketch.buckets = {
+            int(key): count
+            for key, count in data['buckets'].items()
+        }
+        return sketch
@@ -0,0 +1,262 @@
+import heapq
+import json
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import sharedstats
+from .models import Expense, MonthlyStat
+from .sketches import QuantileSketch
+
+# biggest expenses remembered per month, enough for the year dashboard
+LARGEST_KEPT = 5
+
+# decimals totals are kept to: a running float sum drifts with every
+# add and remove, and months holding the same expenses must compare equal
+TOTAL_DECIMALS = 2
+
+
+def month_of(payment_time):
+    # same bucketing as Expense.objects.in_month()
+    local_time = timezone.localtime(payment_time)
+    return local_time.year, local_time.month
+
+
+def day_of(payment_time):
+    return timezone.localtime(payment_time).day
+
+
+def largest_first(pairs, count=LARGEST_KEPT):
+    """
+    The `count` biggest of some (expense id, amount) pairs, largest first.
+    """
+    return heapq.nlargest(count, pairs, key=lambda pair: (pair[1], pair[0]))
+
+
+def _dump_days(days):
+    return json.dumps([[round(total, TOTAL_DECIMALS), count]
+                       for total, count in days])
+
+
+def _apply(year, month, added=(), removed=()):
+    # added and removed are (expense id, day, amount) triples
+    try:
+        with transaction.atomic():
+            stat = MonthlyStat.objects.select_for_update().filter(
+                year=year, month=month).first()
+            if stat is None:
+                stat = MonthlyStat(year=year, month=month)
+
+            sketch = stat.get_sketch()
+            days = stat.get_days()
+            largest = dict(stat.get_largest())
+            for _, day, amount in added:
+                stat.total += float(amount)
+                stat.count += 1
+                days[day - 1][0] += float(amount)
+                days[day - 1][1] += 1
+                sketch.add(amount)
+            for _, day, amount in removed:
+                stat.total -= float(amount)
+                stat.count -= 1
+                days[day - 1][0] -= float(amount)
+                days[day - 1][1] -= 1
+                sketch.remove(amount)
+
+            if (len(largest) >= LARGEST_KEPT
+                    and any(expense_id in largest
+                            for expense_id, _, _ in removed)):
+                # the runner-up was not kept, look it up (the rows are
+                # already written, so this also covers `added`)
+                largest = dict(
+                    Expense.objects.in_month(year, month).order_by(
+                        '-amount', '-id').values_list(
+                            'id', 'amount')[:LARGEST_KEPT])
+            else:
+                for expense_id, _, _ in removed:
+                    largest.pop(expense_id, None)
+            for expense_id, _, amount in added:
+                largest[expense_id] = float(amount)
+
+            stat.total = round(stat.total, TOTAL_DECIMALS)
+            stat.days = _dump_days(days)
+            stat.sketch = sketch.to_json()
+            stat.largest = json.dumps(largest_first(largest.items()))
+            stat.save()
+    except IntegrityError:
+        # somebody else created the month in the meantime
+        _apply(year, month, added, removed)
+        return
+
+    month_changed(year, month)
+
+
+_changed = threading.local()
+
+
+def _changed_months():
+    if not hasattr(_changed, 'months'):
+        _changed.months = set()
+    return _changed.months
+
+
+def month_changed(year, month):
+    # other workers read the month from the shared store, update it once
+    # the change is visible to them; a transaction touching many rows of a
+    # month still refreshes it only once
+    _changed_months().add((year, month))
+    transaction.on_commit(_refresh_changed_months)
+
+
+def _refresh_changed_months():
+    # months left over from a rolled back transaction are refreshed too,
+    # which is harmless: a refresh copies whatever is committed
+    months = _changed_months()
+    while months:
+        sharedstats.month_changed(*months.pop())
+
+
+def expense_added(expense_id, payment_time, amount):
+    _apply(*month_of(payment_time),
+           added=[(expense_id, day_of(payment_time), amount)])
+
+
+def expenses_added(expenses):
+    """
+    Account for expenses inserted without going through save(), e.g. by
+    bulk_create, with one statistics update per month.
+    """
+    amounts = {}
+    for expense in expenses:
+        amounts.setdefault(month_of(expense.payment_time), []).append(
+            (expense.pk, day_of(expense.payment_time), expense.amount))
+    for (year, month), added in amounts.items():
+        _apply(year, month, added=added)
+
+
+def expense_removed(expense_id, payment_time, amount):
+    _apply(*month_of(payment_time),
+           removed=[(expense_id, day_of(payment_time), amount)])
+
+
+def expense_changed(expense_id, payment_time, old_amount, new_amount):
+    day = day_of(payment_time)
+    _apply(*month_of(payment_time),
+           added=[(expense_id, day, new_amount)],
+           removed=[(expense_id, day, old_amount)])
+
+
+def rebuild_month(year, month):
+    """
+    Recompute the statistics of a month from its expenses, for writes that
+    bypass the model (set-based updates and deletes).
+    """
+    with transaction.atomic():
+        # waits for writers updating the month (see _apply) to commit, so
+        # none of their expenses is missed by the recount below
+        MonthlyStat.objects.select_for_update().filter(
+            year=year, month=month).first()
+
+        sketch = QuantileSketch()
+        total = count = 0
+        days = [[0.0, 0] for _ in range(31)]
+        amounts = []
+        for expense_id, payment_time, amount in Expense.objects.in_month(
+                year, month).values_list('id', 'payment_time', 'amount'):
+            sketch.add(amount)
+            total += amount
+            count += 1
+            day = days[day_of(payment_time) - 1]
+            day[0] += amount
+            day[1] += 1
+            amounts.append((expense_id, amount))
+
+        MonthlyStat.objects.update_or_create(
+            year=year,
+            month=month,
+            defaults={
+                'total': round(total, TOTAL_DECIMALS),
+                'count': count,
+                'days': _dump_days(days),
+                'sketch': sketch.to_json(),
+                'largest': json.dumps(largest_first(amounts)),
+            })
+        month_changed(year, month)
+
+
+def months_between(start, end):
+    """
+    Filter for the MonthlyStat rows from `start` to `end`, both
+    (year, month) and inclusive.
+    """
+    (start_year, start_month), (end_year, end_month) = start, end
+    return ((Q(year__gt=start_year)
+             | Q(year=start_year, month__gte=start_month))
+            & (Q(year__lt=end_year) | Q(year=end_year, month__lte=end_month)))
+
+
+def merged_sketch(monthly_stats):
+    sketch = QuantileSketch()
+    for stat in monthly_stats:
+        sketch.merge(stat.get_sketch())
+    return sketch
+
+
+def largest_expenses(monthly_stats):
+    """
+    ExpenseCards of the LARGEST_KEPT biggest expenses over some months,
+    largest first, from the lists kept with their statistics.
+    """
+    ranking = largest_first(pair for stat in monthly_stats
+                            for pair in stat.get_largest())
+    cards = {
+        card.id: card
+        for card in Expense.objects.filter(
+            id__in=[expense_id for expense_id, _ in ranking]).cards()
+    }
+    return [
+        cards[expense_id] for expense_id, _ in ranking if expense_id in cards
+    ]
+
+
+def month_days(year, month):
+    """
+    (day, total) of every day of a month that has expenses, from the
+    shared store when it is enabled, otherwise from its statistics.
+    """
+    shared = sharedstats.month_totals(year, month)
+    if shared is not None:
+        days = zip(shared.days, shared.day_counts)
+    else:
+        stat = MonthlyStat.objects.filter(year=year, month=month).first()
+        days = stat.get_days() if stat else []
+    return [(day, total)
+            for day, (total, count) in enumerate(days, start=1) if count]
+
+
+def month_totals(*months):
+    """
+    Totals of the given (year, month) pairs, from the shared store when
+    it is enabled, otherwise from their statistics. 0 for months without
+    expenses.
+    """
+    totals = dict.fromkeys(months, 0)
+
+    missing = []
+    for year, month in months:
+        shared = sharedstats.month_totals(year, month)
+        if shared is None:
+            missing.append((year, month))
+        else:
+            totals[year, month] = shared.total
+
+    if missing:
+        query = Q()
+        for year, month in missing:
+            query |= Q(year=year, month=month)
+        for year, month, total in MonthlyStat.objects.filter(
+                query).values_list('year', 'month', 'total'):
+            totals[year, month] = total
+    return totals
@@ -1,11 +1,29 @@
-from django.test import TestCase
+from django.contrib.auth.models import Permission, User
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import (Client, LiveServerTestCase, TestCase,
+                         TransactionTestCase, override_settings)
 from django.urls import reverse
 
-from datetime import timedelta
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 from django.utils import timezone
 # Create your tests here.
 
-from .models import Expense
+from . import backups, sharedstats, stats, views
+from .management.commands import loadtest
+from .models import Expense, MonthlyStat
+from .sketches import QuantileSketch
+from .writes import GroupCommitter, _Entry
 
 truncation = 25 - 1
 
@@ -114,7 +132,8 @@ class ExpenseIndexViewTests(TestCase):
 
         self.assertTrue(len(response.context['page_obj']) == 1)
         self.assertQuerysetEqual(response.context['page_obj'],
-                                 ['<Expense: 500.0>'])
+                                 ['500.0'],
+                                 transform=str)
 
     def test_present_expense_with_no_past_expense(self):
         """
@@ -138,7 +157,8 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 1)
 
         self.assertQuerysetEqual(response.context['page_obj'],
-                                 ['<Expense: 500.0>'])
+                                 ['500.0'],
+                                 transform=str)
 
     def test_present_expense_with_more_past_expense(self):
         """
@@ -162,7 +182,8 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 1)
 
         self.assertQuerysetEqual(response.context['page_obj'],
-                                 ['<Expense: 500.0>'])
+                                 ['500.0'],
+                                 transform=str)
 
     def test_present_expense_with_less_past_expense(self):
         """
@@ -186,7 +207,8 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 1)
 
         self.assertQuerysetEqual(response.context['page_obj'],
-                                 ['<Expense: 500.0>'])
+                                 ['500.0'],
+                                 transform=str)
 
     def test_present_expense_with_same_past_expense(self):
         """
@@ -211,7 +233,8 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 1)
 
         self.assertQuerysetEqual(response.context['page_obj'],
-                                 ['<Expense: 500.0>'])
+                                 ['500.0'],
+                                 transform=str)
 
     def test_present_expense_with_multiple_expenses_less_than_page_objects(
             self):
@@ -236,9 +259,10 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 3)
 
         self.assertQuerysetEqual(response.context['page_obj'], [
-            repr(x) for x in Expense.objects.filter(payment_time__month=month,
-                                                    payment_time__year=year)
-        ])
+            str(x) for x in Expense.objects.filter(payment_time__month=month,
+                                                   payment_time__year=year)
+        ],
+                                 transform=str)
 
     def test_present_expense_with_multiple_expenses_more_than_page_objects(
             self):
@@ -263,10 +287,26 @@ class ExpenseIndexViewTests(TestCase):
         self.assertTrue(len(response.context['page_obj']) == 6)
 
         self.assertQuerysetEqual(response.context['page_obj'], [
-            repr(x)
+            str(x)
             for x in Expense.objects.filter(payment_time__month=month,
                                             payment_time__year=year)[:6]
-        ])
+        ],
+                                 transform=str)
+
+    def test_index_renders_projected_cards(self):
+        now = timezone.now()
+        year, month = now.year, now.month
+
+        add_expense(amount=500, title='t' * 100, desc='d' * 200)
+
+        response = self.client.get(
+            reverse('expenses:index', args=(year, month)))
+
+        card = response.context['page_obj'][0]
+        self.assertEqual(len(card.title), 26)
+        self.assertEqual(len(card.description), 26)
+        self.assertContains(response, 'd' * truncation + '…')
+        self.assertEqual(response.context['curr_monthly_expense'], 500)
 
     def test_expense_intcomma(self):
         now = timezone.now()
@@ -303,6 +343,194 @@ class ExpenseIndexViewTests(TestCase):
         self.assertContains(response, '1.2 billion', count=3)
 
 
+class ExpenseCardsFragmentTests(TestCase):
+    def test_cursor_walks_whole_month(self):
+        now = timezone.now()
+        year, month = now.year, now.month
+        same_time = timezone.now()
+        for i in range(8):
+            add_expense(amount=i)
+        for i in range(6):
+            # ties on payment_time are broken by id
+            Expense.objects.create(amount=100 + i,
+                                   payment_time=same_time,
+                                   title='tie',
+                                   description='')
+
+        index_response = self.client.get(
+            reverse('expenses:index', args=(year, month)))
+        seen = [card.id for card in index_response.context['page_obj']]
+        cursor = index_response.context['next_cursor']
+        self.assertContains(index_response, 'data-next=')
+
+        while cursor:
+            with self.assertNumQueries(1):
+                response = self.client.get(
+                    reverse('expenses:expense_cards', args=(year, month)),
+                    {'after': cursor})
+            self.assertNotContains(response, '<html')
+            seen += [card.id for card in response.context['expenses']]
+            cursor = response.context['next_cursor']
+
+        self.assertEqual(
+            seen,
+            list(Expense.objects.in_month(year,
+                                          month).values_list('id', flat=True)))
+
+    def test_first_page_without_cursor(self):
+        now = timezone.now()
+        add_expense(amount=500)
+
+        response = self.client.get(
+            reverse('expenses:expense_cards', args=(now.year, now.month)))
+
+        self.assertEqual(len(response.context['expenses']), 1)
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertNotContains(response, 'data-next=')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(
+            reverse('expenses:expense_cards', args=(2020, 3)),
+            {'after': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BatchApiTests(TestCase):
+    def post_batch(self, expenses):
+        return self.client.post(reverse('expenses:api_add_expenses'),
+                                data=json.dumps({'expenses': expenses}),
+                                content_type='application/json')
+
+    def test_batch_is_idempotent(self):
+        batch = [{
+            'idempotency_key': 'bank-%d' % n,
+            'title': 'Groceries',
+            'amount': 100 * n,
+            'payment_time': '2020-03-0%dT10:00:00' % n,
+        } for n in range(1, 4)]
+
+        response = self.post_batch(batch)
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['created'] * 3)
+        ids = [r['id'] for r in results]
+
+        retry = self.post_batch(batch).json()['results']
+        self.assertEqual([r['status'] for r in retry], ['duplicate'] * 3)
+        self.assertEqual([r['id'] for r in retry], ids)
+
+        self.assertEqual(Expense.objects.count(), 3)
+        self.assertEqual(MonthlyStat.objects.get(year=2020, month=3).total,
+                         600)
+
+    def test_per_item_validation(self):
+        response = self.post_batch([
+            {
+                'idempotency_key': 'a',
+                'title': 'Taxi',
+                'amount': '250.5'
+            },
+            {
+                'idempotency_key': 'a',
+                'title': 'Taxi again',
+                'amount': 1
+            },
+            {
+                'idempotency_key': 'b',
+                'title': '',
+                'amount': -3,
+                'payment_time': 'yesterday'
+            },
+            'not an expense',
+        ])
+
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results],
+                         ['created', 'duplicate', 'invalid', 'invalid'])
+        self.assertEqual(set(results[2]['errors']),
+                         {'title', 'amount', 'payment_time'})
+        self.assertEqual(Expense.objects.get().amount, 250.5)
+
+    def test_malformed_requests(self):
+        response = self.client.post(reverse('expenses:api_add_expenses'),
+                                    data='nope',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post_batch([{}] * 501)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(reverse('expenses:api_add_expenses'))
+        self.assertEqual(response.status_code, 405)
+
+    def test_locked_database_is_retried(self):
+        insert_batch = views.insert_batch
+        calls = []
+
+        def locked_once(expenses):
+            calls.append(expenses)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return insert_batch(expenses)
+
+        with mock.patch.object(views, 'insert_batch', locked_once), \
+                mock.patch.object(views.time, 'sleep'):
+            response = self.post_batch([{
+                'idempotency_key': 'a',
+                'title': 'Taxi',
+                'amount': 1
+            }])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(response.json()['results'][0]['status'], 'created')
+
+    def test_only_json_is_accepted(self):
+        # what a cross-site <form enctype="text/plain"> could send
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(reverse('expenses:api_add_expenses'),
+                               data=json.dumps({
+                                   'expenses': [{
+                                       'idempotency_key': 'a',
+                                       'title': 'Taxi',
+                                       'amount': 1
+                                   }]
+                               }),
+                               content_type='text/plain')
+
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse(Expense.objects.exists())
+
+    @override_settings(EXPENSE_API_TOKEN='s3cret')
+    def test_api_token(self):
+        batch = json.dumps({
+            'expenses': [{
+                'idempotency_key': 'a',
+                'title': 'Taxi',
+                'amount': 1
+            }]
+        })
+        url = reverse('expenses:api_add_expenses')
+
+        response = self.client.post(url,
+                                    data=batch,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post(url,
+                                    data=batch,
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(Expense.objects.exists())
+
+        response = self.client.post(url,
+                                    data=batch,
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Expense.objects.count(), 1)
+
+
 class ExpenseDetailViewTests(TestCase):
     def test_detail_no_expenses(self):
         test_id = 1  # number doesn't matter as there is no item yet
@@ -405,6 +633,776 @@ class ExpenseUpdateTests(TestCase):
         self.assertContains(index_response, update_title[:24])  # truncation
         self.assertContains(index_response, update_desc[:24])  # truncation
 
+    def test_update_bumps_version(self):
+        e = add_expense(amount=500)
+        self.client.post(reverse('expenses:update', args=(e.id, )),
+                         data={
+                             'price': 700,
+                             'version': e.version
+                         })
+
+        e.refresh_from_db()
+        self.assertEqual(e.amount, 700)
+        self.assertEqual(e.version, 1)
+
+    def test_update_with_stale_version(self):
+        e = add_expense(amount=500, title='original title')
+        path_to_post = reverse('expenses:update', args=(e.id, ))
+
+        self.client.post(path_to_post, data={'price': 700, 'version': 0})
+        response = self.client.post(path_to_post,
+                                    data={
+                                        'title': 'lost update',
+                                        'price': 900,
+                                        'version': 0
+                                    },
+                                    follow=True)
+
+        self.assertContains(response, 'changed</b> by someone else')
+        e.refresh_from_db()
+        self.assertEqual(e.title, 'original title')
+        self.assertEqual(e.amount, 700)
+        self.assertEqual(MonthlyStat.objects.get().total, 700)
+
+    def test_update_invalid_amount(self):
+        e = add_expense(amount=500)
+        response = self.client.post(reverse('expenses:update',
+                                            args=(e.id, )),
+                                    data={'price': 'a lot'},
+                                    follow=True)
+
+        self.assertContains(response, 'Please enter a valid amount!')
+        e.refresh_from_db()
+        self.assertEqual(e.amount, 500)
+
+    def test_update_malformed_version(self):
+        e = add_expense(amount=500)
+        response = self.client.post(reverse('expenses:update',
+                                            args=(e.id, )),
+                                    data={
+                                        'price': 600,
+                                        'version': 'stale'
+                                    },
+                                    follow=True)
+
+        self.assertContains(response, 'The form was <b>out of date</b>')
+        self.assertNotContains(response, 'Please enter a valid amount!')
+        e.refresh_from_db()
+        self.assertEqual(e.amount, 500)
+
+
+class ExpenseAddTests(TestCase):
+    def test_add_invalid_amount(self):
+        response = self.client.post(reverse('expenses:add'),
+                                    data={
+                                        'title': 'test',
+                                        'price': '-5'
+                                    },
+                                    follow=True)
+
+        self.assertContains(response, 'Please enter a valid amount!')
+        self.assertEqual(Expense.objects.count(), 0)
+
+
+def add_expense_on(year, month, day, amount=0, title="default title"):
+    time = timezone.make_aware(datetime(year, month, day, 12))
+
+    return Expense.objects.create(amount=amount,
+                                  payment_time=time,
+                                  title=title,
+                                  description="default desc")
+
+
+class MonthlyStatTests(TestCase):
+    def get_stat(self, year, month):
+        return MonthlyStat.objects.get(year=year, month=month)
+
+    def test_stats_follow_add_update_delete(self):
+        e = add_expense_on(2020, 3, 10, amount=500)
+        add_expense_on(2020, 3, 11, amount=250)
+        self.assertEqual(self.get_stat(2020, 3).total, 750)
+        self.assertEqual(self.get_stat(2020, 3).count, 2)
+
+        self.client.post(reverse('expenses:update', args=(e.id, )),
+                         data={'price': 1000})
+        self.assertEqual(self.get_stat(2020, 3).total, 1250)
+
+        self.client.post(reverse('expenses:delete_expense', args=(e.id, )))
+        self.assertEqual(self.get_stat(2020, 3).total, 250)
+        self.assertEqual(self.get_stat(2020, 3).count, 1)
+
+    def test_moving_expense_to_another_month(self):
+        e = add_expense_on(2020, 3, 10, amount=500)
+        e = Expense.objects.get(id=e.id)
+        e.payment_time = timezone.make_aware(datetime(2020, 4, 1, 12))
+        e.save()
+
+        self.assertEqual(self.get_stat(2020, 3).total, 0)
+        self.assertEqual(self.get_stat(2020, 4).total, 500)
+
+    def test_delete_monthly_expenses(self):
+        for day in range(1, 4):
+            add_expense_on(2020, 3, day, amount=100)
+
+        self.client.post(reverse('expenses:delete_monthly', args=(2020, 3)))
+        self.assertEqual(self.get_stat(2020, 3).count, 0)
+
+    def test_total_does_not_drift(self):
+        for day, amount in ((1, 0.1), (2, 0.2), (3, 0.3)):
+            e = add_expense_on(2020, 3, day, amount=amount)
+        e.delete()
+        add_expense_on(2020, 4, 1, amount=0.1)
+        add_expense_on(2020, 4, 2, amount=0.2)
+
+        self.assertEqual(self.get_stat(2020, 3).total, 0.3)
+        self.assertEqual(self.get_stat(2020, 4).total, 0.3)
+        response = self.client.get(reverse('expenses:index', args=(2020, 4)))
+        self.assertEqual(response.context['progress']['tail'],
+                         'Same as last month')
+
+    def test_largest_expenses_are_kept(self):
+        expenses = [
+            add_expense_on(2020, 3, day, amount=day * 100)
+            for day in range(1, 9)
+        ]
+
+        def largest():
+            return [
+                amount for _, amount in self.get_stat(2020, 3).get_largest()
+            ]
+
+        self.assertEqual(largest(), [800, 700, 600, 500, 400])
+
+        # a kept one shrinks, the runner-up moves in
+        self.client.post(reverse('expenses:update', args=(expenses[7].id, )),
+                         data={'price': 50})
+        self.assertEqual(largest(), [700, 600, 500, 400, 300])
+
+        # one that was not kept grows past all of them
+        self.client.post(reverse('expenses:update', args=(expenses[0].id, )),
+                         data={'price': 900})
+        self.assertEqual(largest(), [900, 700, 600, 500, 400])
+
+        self.client.post(
+            reverse('expenses:delete_expense', args=(expenses[6].id, )))
+        self.assertEqual(largest(), [900, 600, 500, 400, 300])
+
+        kept = self.get_stat(2020, 3).largest
+        stats.rebuild_month(2020, 3)
+        self.assertEqual(self.get_stat(2020, 3).largest, kept)
+
+
+class ExpenseQuerySetTests(TestCase):
+    def test_in_month_uses_local_month_bounds(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        add_expense_on(2020, 3, 31, amount=200)
+        add_expense_on(2020, 4, 1, amount=300)
+        # 20:00 UTC on the 31st is already April 1st in Asia/Kolkata
+        Expense.objects.create(amount=400,
+                               payment_time=datetime(2020, 3, 31, 20,
+                                                     tzinfo=timezone.utc),
+                               title='late',
+                               description='')
+
+        march = Expense.objects.in_month(2020, 3)
+        self.assertEqual(sorted(e.amount for e in march), [100, 200])
+        self.assertEqual(
+            sorted(e.amount for e in Expense.objects.in_month(2020, 4)),
+            [300, 400])
+        self.assertNotIn('django_datetime_extract', str(march.query))
+
+    def test_in_year_across_december(self):
+        add_expense_on(2019, 12, 31, amount=100)
+        add_expense_on(2020, 12, 31, amount=200)
+
+        self.assertEqual([e.amount for e in Expense.objects.in_year(2020)],
+                         [200])
+        self.assertEqual(
+            [e.amount for e in Expense.objects.in_month(2019, 12)], [100])
+
+    def test_purge_year(self):
+        add_expense_on(2019, 6, 1, amount=100)
+        add_expense_on(2020, 6, 1, amount=200)
+
+        call_command('purge_year', 2019, interactive=False, stdout=StringIO())
+
+        self.assertEqual([e.amount for e in Expense.objects.all()], [200])
+        self.assertFalse(MonthlyStat.objects.filter(year=2019).exists())
+        self.assertTrue(MonthlyStat.objects.filter(year=2020).exists())
+
+
+class YearDashboardViewTests(TestCase):
+    def test_no_expenses(self):
+        response = self.client.get(
+            reverse('expenses:year_dashboard', args=(2020, )))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "You didn't spend a single penny")
+
+    def test_year_overview(self):
+        add_expense_on(2020, 1, 5, amount=300)
+        add_expense_on(2020, 1, 6, amount=700)
+        add_expense_on(2020, 6, 1, amount=200, title='Biggest one')
+        add_expense_on(2019, 12, 31, amount=5000)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse('expenses:year_dashboard', args=(2020, )))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['yearly_expense'], 1200)
+        self.assertEqual(response.context['last_yearly_expense'], 5000)
+        self.assertEqual(response.context['highest']['date'].month, 1)
+        self.assertEqual(response.context['lowest']['date'].month, 6)
+        self.assertEqual(response.context['average'], 600)
+        self.assertEqual(len(response.context['months']), 12)
+        self.assertEqual(
+            [e.amount for e in response.context['largest_expenses']],
+            [700, 300, 200])
+        self.assertContains(response, "badge-saved")
+        self.assertContains(response, "less than last year")
+
+
+class QuantileSketchTests(TestCase):
+    def test_quantiles_within_relative_accuracy(self):
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        amounts = list(range(1, 1001))
+        for amount in amounts:
+            sketch.add(amount)
+
+        for q in (0.25, 0.5, 0.95, 0.99):
+            exact = amounts[int(q * (len(amounts) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), exact,
+                                   delta=exact * 0.01)
+
+    def test_merge_and_remove(self):
+        first, second = QuantileSketch(), QuantileSketch()
+        for amount in (10, 20, 30):
+            first.add(amount)
+        for amount in (40, 0):
+            second.add(amount)
+
+        merged = QuantileSketch.from_json(first.to_json()).merge(second)
+        self.assertEqual(merged.count, 5)
+        self.assertEqual(merged.quantile(0), 0)
+
+        merged.remove(40)
+        merged.remove(0)
+        self.assertEqual(merged.to_json(), first.to_json())
+
+    def test_histogram_covers_all_amounts(self):
+        sketch = QuantileSketch()
+        for amount in (5, 50, 500, 5000):
+            sketch.add(amount)
+
+        histogram = sketch.histogram(bins=4)
+        self.assertEqual(len(histogram), 4)
+        self.assertEqual(sum(count for _, _, count in histogram), 4)
+        self.assertEqual(QuantileSketch().histogram(), [])
+
+
+class MonthlyDistributionViewTests(TestCase):
+    def test_distribution_over_months(self):
+        for amount in (100, 200, 300):
+            add_expense_on(2020, 2, 1, amount=amount)
+        e = add_expense_on(2020, 3, 1, amount=10000)
+        self.client.post(reverse('expenses:update', args=(e.id, )),
+                         data={'price': 400})
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse('expenses:monthly_distribution', args=(2020, 3)),
+                {'months': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['count'], 4)
+        median = response.context['percentiles'][1]
+        self.assertEqual(median['rank'], 50)
+        self.assertAlmostEqual(median['amount'], 200, delta=2)
+        self.assertEqual(sum(response.context['data']), 4)
+
+    def test_no_expenses(self):
+        response = self.client.get(
+            reverse('expenses:monthly_distribution', args=(2020, 3)))
+        self.assertContains(response, "You didn't spend a single penny")
+
+
+class ExpenseAdminTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+
+    def test_changelist_skips_full_count(self):
+        for day in range(1, 4):
+            add_expense_on(2020, 3, day, amount=100)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:expenses_expense_changelist'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertFalse([
+            query['sql'] for query in queries.captured_queries
+            if 'COUNT(' in query['sql'] and 'expenses_expense' in query['sql']
+        ])
+
+    def test_month_filter(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        add_expense_on(2020, 4, 1, amount=200)
+
+        response = self.client.get(
+            reverse('admin:expenses_expense_changelist'), {'month': '2020-4'})
+
+        self.assertEqual([e.amount for e in response.context['cl'].result_list],
+                         [200])
+
+    def test_bulk_delete_action(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        e = add_expense_on(2020, 3, 2, amount=200)
+        add_expense_on(2020, 4, 1, amount=300)
+
+        selection = {
+            'action': 'delete_expenses',
+            '_selected_action': [e.id],
+        }
+        response = self.client.post(
+            reverse('admin:expenses_expense_changelist'), selection)
+
+        # nothing is deleted before it is confirmed
+        self.assertContains(response, 'Are you sure')
+        self.assertContains(response, '2020/03')
+        self.assertEqual(Expense.objects.count(), 3)
+
+        self.client.post(reverse('admin:expenses_expense_changelist'),
+                         dict(selection, post='yes'))
+
+        self.assertEqual(Expense.objects.count(), 2)
+        march = MonthlyStat.objects.get(year=2020, month=3)
+        self.assertEqual((march.total, march.count), (100, 1))
+
+    def test_recalculate_needs_change_permission(self):
+        viewer = User.objects.create_user('viewer', password='pass',
+                                          is_staff=True)
+        viewer.user_permissions.add(
+            Permission.objects.get(codename='view_expense'))
+        self.client.login(username='viewer', password='pass')
+
+        response = self.client.get(
+            reverse('admin:expenses_expense_changelist'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('recalculate_monthly_stats',
+                         response.context['cl'].model_admin.get_actions(
+                             response.wsgi_request))
+
+    def test_change_with_stale_version_is_refused(self):
+        e = add_expense_on(2020, 3, 1, amount=100)
+        url = reverse('admin:expenses_expense_change', args=(e.id, ))
+        form = self.client.get(url).context['adminform'].form
+        data = {
+            'title': e.title,
+            'description': e.description,
+            'amount': 150,
+            'payment_time_0': '2020-03-01',
+            'payment_time_1': '12:00:00',
+            'loaded_version': form['loaded_version'].value(),
+        }
+
+        # somebody saves the expense from the update page meanwhile
+        self.client.post(reverse('expenses:update', args=(e.id, )),
+                         data={'price': 200})
+
+        response = self.client.post(url, data)
+        self.assertContains(response, 'changed by someone else')
+        e.refresh_from_db()
+        self.assertEqual(e.amount, 200)
+
+        data['loaded_version'] = e.version
+        self.client.post(url, data)
+        e.refresh_from_db()
+        self.assertEqual((e.amount, e.version), (150, 2))
+
+
+@override_settings(EXPENSE_WRITE_BATCHING=True)
+class ExpenseAddBatchedTests(TestCase):
+    def test_add_expense_batched(self):
+        now = timezone.now()
+        year, month = now.year, now.month
+
+        response = self.client.post(reverse('expenses:add'),
+                                    data={
+                                        'title': 'batched',
+                                        'desc': 'batched desc',
+                                        'price': 750
+                                    })
+
+        self.assertEqual(response.status_code, 302)
+        index_response = self.client.get(
+            reverse('expenses:index', args=(year, month)))
+        self.assertContains(index_response,
+                            'Successfully <b>added</b> the expense!')
+        self.assertContains(index_response, '750.0', count=3)
+
+
+class GroupCommitterTests(TransactionTestCase):
+    def test_concurrent_inserts_are_all_committed(self):
+        committer = GroupCommitter(max_batch=4, max_delay=0.05)
+        saved = []
+
+        def insert(n):
+            try:
+                saved.append(
+                    committer.submit(
+                        Expense(title='t%d' % n,
+                                description='',
+                                amount=n,
+                                payment_time=timezone.now())))
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=insert, args=(n, )) for n in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(saved), 10)
+        self.assertTrue(all(expense.pk for expense in saved))
+        self.assertEqual(Expense.objects.count(), 10)
+
+    def test_failed_statistics_update_rolls_back_its_row(self):
+        committer = GroupCommitter(max_batch=3, max_delay=0)
+        batch = [
+            _Entry(
+                Expense(title='t%d' % amount,
+                        description='',
+                        amount=amount,
+                        payment_time=timezone.now()))
+            for amount in (10, 13, 20)
+        ]
+        expense_added = stats.expense_added
+
+        def failing_expense_added(expense_id, payment_time, amount):
+            if amount == 13:
+                raise RuntimeError('statistics update failed')
+            expense_added(expense_id, payment_time, amount)
+
+        with mock.patch.object(stats, 'expense_added', failing_expense_added):
+            committer._flush(batch)
+
+        self.assertIsInstance(batch[1].error, RuntimeError)
+        self.assertEqual(
+            sorted(Expense.objects.values_list('amount', flat=True)),
+            [10, 20])
+        stat = MonthlyStat.objects.get()
+        self.assertEqual((stat.total, stat.count), (30, 2))
+
+
+class SharedStatsTests(TransactionTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'shared.stats')
+        settings_override = override_settings(
+            EXPENSE_SHARED_STATS_PATH=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def other_worker(self):
+        store = sharedstats.SharedMonthStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_write_views_update_shared_totals(self):
+        now = timezone.now()
+        year, month = now.year, now.month
+
+        self.client.post(reverse('expenses:add'),
+                         data={
+                             'title': 'shared',
+                             'desc': 'shared desc',
+                             'price': 300
+                         })
+        e = Expense.objects.get()
+        self.client.post(reverse('expenses:update', args=(e.id, )),
+                         data={'price': 450})
+
+        totals = self.other_worker().read(year, month)
+        self.assertEqual((totals.total, totals.count), (450, 1))
+        self.assertEqual(totals.days[timezone.localtime(e.payment_time).day -
+                                     1], 450)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                reverse('expenses:monthly_chart', args=(year, month)))
+        self.assertEqual(response.context['data'], [450])
+
+        self.client.post(reverse('expenses:delete_expense', args=(e.id, )))
+        self.assertEqual(self.other_worker().read(year, month).total, 0)
+
+    def test_one_refresh_per_month_and_transaction(self):
+        for day in range(1, 21):
+            add_expense_on(2020, 3, day, amount=100)
+
+        with mock.patch.object(
+                sharedstats.SharedMonthStore,
+                'refresh',
+                autospec=True,
+                side_effect=sharedstats.SharedMonthStore.refresh) as refresh:
+            self.client.post(
+                reverse('expenses:delete_monthly', args=(2020, 3)))
+
+        self.assertEqual(refresh.call_count, 1)
+        self.assertEqual(self.other_worker().read(2020, 3).total, 0)
+
+    def test_writes_do_not_scan_the_month(self):
+        for day in range(1, 11):
+            add_expense_on(2020, 3, day, amount=100)
+
+        with CaptureQueriesContext(connection) as queries:
+            add_expense_on(2020, 3, 11, amount=50)
+
+        self.assertFalse([
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('SELECT')
+            and 'FROM "expenses_expense"' in query['sql']
+        ])
+        totals = self.other_worker().read(2020, 3)
+        self.assertEqual((totals.total, totals.count), (1050, 11))
+        self.assertEqual((totals.days[10], totals.day_counts[10]), (50, 1))
+
+    def test_chart_lists_the_same_days_with_and_without_store(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        add_expense_on(2020, 3, 2, amount=0)
+        url = reverse('expenses:monthly_chart', args=(2020, 3))
+
+        shared = self.client.get(url).context
+        with override_settings(EXPENSE_SHARED_STATS_PATH=None):
+            database = self.client.get(url).context
+
+        self.assertEqual(shared['data'], [100, 0])
+        self.assertEqual(database['data'], shared['data'])
+        self.assertEqual(database['labels'], shared['labels'])
+
+        days = MonthlyStat.objects.get(year=2020, month=3).days
+        stats.rebuild_month(2020, 3)
+        self.assertEqual(MonthlyStat.objects.get(year=2020, month=3).days,
+                         days)
+
+    def test_read_miss_fills_slot(self):
+        with override_settings(EXPENSE_SHARED_STATS_PATH=None):
+            # expenses from before the store was turned on
+            add_expense_on(2020, 3, 1, amount=100)
+        store = self.other_worker()
+        self.assertIsNone(store.read(2020, 3))
+
+        response = self.client.get(reverse('expenses:index', args=(2020, 4)))
+
+        self.assertEqual(response.context['last_monthly_expense'], 100)
+        self.assertEqual(store.read(2020, 3).total, 100)
+        self.assertEqual(store.read(2020, 4).total, 0)
+
+    def test_new_process_drops_stale_slots(self):
+        store = self.other_worker()
+        add_expense_on(2020, 3, 1, amount=100)
+        store.refresh(2020, 3)
+
+        with override_settings(EXPENSE_SHARED_STATS_PATH=None):
+            # e.g. `manage.py shell` without the setting
+            add_expense_on(2020, 3, 2, amount=50)
+        self.assertEqual(store.read(2020, 3).total, 100)
+
+        # a restarted worker starts a new generation
+        sharedstats.get_store().close()
+        sharedstats._store = None
+        sharedstats.get_store()
+        self.assertIsNone(store.read(2020, 3))
+        self.assertEqual(sharedstats.month_totals(2020, 3).total, 150)
+
+    def test_file_of_another_database_is_reset(self):
+        store = self.other_worker()
+        add_expense_on(2020, 3, 1, amount=100)
+        store.refresh(2020, 3)
+
+        with mock.patch.object(sharedstats,
+                               'database_identity',
+                               return_value=bytes(32)):
+            other_database = self.other_worker()
+        self.assertIsNone(other_database.read(2020, 3))
+        self.assertIsNone(store.read(2020, 3))
+
+        self.assertEqual(store.refresh(2020, 3).total, 100)
+        self.assertEqual(store.read(2020, 3).total, 100)
+        self.assertIsNone(other_database.read(2020, 3))
+
+    def test_slot_being_written_is_not_read(self):
+        store = self.other_worker()
+        store.refresh(2020, 3)
+        offset = store.offset(2020, 3)
+        sequence, = sharedstats.SEQUENCE.unpack_from(store.map, offset)
+        sharedstats.SEQUENCE.pack_into(store.map, offset, sequence + 1)
+
+        self.assertIsNone(store.read(2020, 3))
+        self.assertIsNone(store.read(1999, 12))
+
+
+class BackupCommandTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def backup(self, **options):
+        call_command('backup', dir=self.directory, stdout=StringIO(),
+                     stderr=StringIO(), **options)
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.gz'))
+
+    def test_backup_verify_and_restore(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        add_expense_on(2020, 4, 1, amount=200)
+
+        snapshot = os.path.join(self.directory, self.backup(pages=1)[0])
+        self.assertTrue(os.path.exists(snapshot + '.sha256'))
+        self.assertTrue(os.path.exists(snapshot + '.manifest.json'))
+        self.backup(verify=snapshot)
+
+        # later writes do not make the snapshot fail verification
+        add_expense_on(2020, 4, 2, amount=300)
+        self.backup(verify=snapshot)
+
+        call_command('restore', snapshot, interactive=False, stdout=StringIO())
+
+        self.assertEqual(sorted(e.amount for e in Expense.objects.all()),
+                         [100, 200])
+        self.assertEqual(MonthlyStat.objects.get(year=2020, month=4).total,
+                         200)
+
+    def test_summary_uses_local_months(self):
+        # 1 April 00:30 in Kolkata is still March in UTC
+        Expense.objects.create(title='t',
+                               description='d',
+                               amount=100,
+                               payment_time=timezone.make_aware(
+                                   datetime(2020, 4, 1, 0, 30)))
+
+        summary = backups.summarize(backups.live_connection())
+
+        self.assertEqual(summary['months'], {'2020-04': [1, 100]})
+
+    def test_copy_finishes_under_concurrent_writes(self):
+        path = os.path.join(self.directory, 'busy.sqlite3')
+        source = sqlite3.connect(path, check_same_thread=False)
+        self.addCleanup(source.close)
+        source.execute('CREATE TABLE t (x)')
+        source.executemany('INSERT INTO t VALUES (?)',
+                           [('x' * 500, )] * 5000)
+        source.commit()
+
+        stop = threading.Event()
+
+        def writer():
+            connection = sqlite3.connect(path, timeout=5)
+            while not stop.is_set():
+                connection.execute("INSERT INTO t VALUES ('y')")
+                connection.commit()
+                time.sleep(0.005)
+            connection.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+        target = sqlite3.connect(':memory:')
+        restarts = backups.copy_online(source,
+                                       target,
+                                       pages=1,
+                                       pause=0.01,
+                                       max_restarts=2)
+
+        self.assertGreater(restarts, 2)
+        self.assertGreaterEqual(
+            target.execute('SELECT COUNT(*) FROM t').fetchone()[0], 5000)
+        backups.quick_check(target)
+
+    def test_rotation(self):
+        for _ in range(3):
+            kept = self.backup(keep=2)
+
+        self.assertEqual(len(kept), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 6)
+
+    def test_snapshot_not_matching_its_manifest(self):
+        add_expense_on(2020, 3, 1, amount=100)
+        snapshot = os.path.join(self.directory, self.backup()[0])
+
+        with open(snapshot + '.manifest.json') as handle:
+            manifest = json.load(handle)
+        manifest['tables']['expenses_expense'] += 1
+        with open(snapshot + '.manifest.json', 'w') as handle:
+            json.dump(manifest, handle)
+
+        with self.assertRaisesMessage(CommandError,
+                                      'does not match its manifest'):
+            self.backup(verify=snapshot)
+
+        os.remove(snapshot + '.manifest.json')
+        with self.assertRaisesMessage(CommandError, 'No manifest found'):
+            self.backup(verify=snapshot)
+
+    def test_corrupt_snapshot_is_refused(self):
+        snapshot = os.path.join(self.directory, self.backup()[0])
+        with open(snapshot, 'ab') as handle:
+            handle.write(b'garbage')
+
+        with self.assertRaisesMessage(CommandError, 'Checksum mismatch'):
+            call_command('restore', snapshot, interactive=False,
+                         stdout=StringIO())
+
+
+class LoadTestCommandTests(LiveServerTestCase):
+    def test_mixed_workload_report(self):
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+
+        call_command('loadtest',
+                     url=self.live_server_url,
+                     concurrency=1,
+                     requests=40,
+                     seed_expenses=3,
+                     label='test run',
+                     output=output,
+                     stdout=StringIO())
+
+        with open(output) as handle:
+            results = json.load(handle)
+
+        self.assertEqual(results['label'], 'test run')
+        rows = {row['endpoint']: row for row in results['endpoints']}
+        self.assertEqual(rows['all']['requests'], 40)
+        self.assertEqual(rows['all']['errors'], 0)
+        self.assertLessEqual(rows['all']['p50_ms'], rows['all']['p99_ms'])
+        self.assertIn('detail', rows)  # seeded expenses were discovered
+        self.assertGreaterEqual(Expense.objects.count(), 3)
+
+    def test_redirect_back_to_form_is_an_error(self):
+        command = loadtest.Command()
+        command.expense_ids = [1]
+
+        class FormClient:
+            def __init__(self, location):
+                self.location = location
+
+            def token(self):
+                return 'token'
+
+            def request(self, path, data=None):
+                return 302, '', self.location or path
+
+        rng = random.Random(0)
+        self.assertTrue(command.hit_add(FormClient('/'), rng))
+        self.assertFalse(command.hit_add(FormClient(None), rng))
+        self.assertTrue(command.hit_update(FormClient('/expense/1/1/'), rng))
+        self.assertFalse(command.hit_update(FormClient(None), rng))
+
 
 # Remaining ------------------------
 # tests for --> monthly chart (GET)
@@ -6,6 +6,9 @@ app_name = "expenses"
 urlpatterns = [
     path('', views.home, name='home'),
     path('expense/<int:year_num>/<int:month_num>/', views.index, name='index'),
+    path('expense/<int:year_num>/<int:month_num>/cards/',
+         views.expense_cards,
+         name='expense_cards'),
     path('expense/detail/<int:expense_id>/', views.detail, name='detail'),
     path('expense/add/', views.add_expense, name='add'),
     path('expense/update/<int:expense_id>/',
@@ -21,4 +24,13 @@ urlpatterns = [
     path('expense/chart/<int:year_num>/<int:month_num>/',
          views.monthly_chart,
          name='monthly_chart'),
+    path('expense/distribution/<int:year_num>/<int:month_num>/',
+         views.monthly_distribution,
+         name='monthly_distribution'),
+    path('api/expenses/batch/',
+         views.api_add_expenses,
+         name='api_add_expenses'),
+    path('expense/year/<int:year_num>/',
+         views.year_dashboard,
+         name='year_dashboard'),
 ]
\ No newline at end of file
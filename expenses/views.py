@@ -1,18 +1,87 @@
+from django.conf import settings
 from django.contrib.messages.constants import SUCCESS
 from django.core.paginator import Paginator
 from django.contrib import messages
-from django.db.models import Sum
-
-from datetime import datetime, timedelta
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import F
+
+import hmac
+import json
+import math
+import time
+from datetime import date, datetime, timedelta
 from calendar import monthrange
-from django.http.response import HttpResponseRedirect
+from django.http.response import (HttpResponseBadRequest,
+                                  HttpResponseRedirect, JsonResponse)
 from django.urls import reverse
 from django.shortcuts import get_list_or_404, get_object_or_404, render
-from .models import Expense
+from . import stats
+from .models import Expense, MonthlyStat
+from .writes import save_expense
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 # Create your views here.
 
+CARDS_PER_PAGE = 6
+
+MAX_BATCH_SIZE = 500
+BATCH_ATTEMPTS = 5
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def compare_spending(current, previous, period):
+    """
+    Badge telling whether more, less or the same was spent than in the
+    previous `period` (e.g. 'last month').
+    """
+    progress = {}
+    progress['color'] = {}
+    if current > previous:
+        progress['color']['bg'] = 'expended'
+        progress['color']['text'] = 'light'
+        progress['tail'] = 'more than'
+    elif current < previous:
+        progress['color']['bg'] = 'saved'
+        progress['color']['text'] = 'dark'
+        progress['tail'] = 'less than'
+    else:
+        progress['color']['bg'] = 'same'
+        progress['color']['text'] = 'light'
+        progress['tail'] = 'Same as'
+
+    progress['tail'] += ' ' + period
+    progress['difference'] = abs(current - previous)
+
+    return progress
+
+
+def card_cursor(card):
+    """
+    Position of a card in the month's listing, as '<microseconds>-<id>'.
+    """
+    return '%d-%d' % ((card.payment_time - EPOCH) // timedelta(microseconds=1),
+                      card.id)
+
+
+def parse_cursor(cursor):
+    microseconds, expense_id = (int(part) for part in cursor.split('-'))
+    return EPOCH + timedelta(microseconds=microseconds), expense_id
+
+
+def parse_amount(raw):
+    """
+    Amount entered in a form as a float, ValueError if it is not a
+    finite, non-negative number.
+    """
+    amount = float(raw)
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError('Invalid amount: %r' % raw)
+    return amount
+
 
 def home(request):
     now = timezone.now()
@@ -28,15 +97,12 @@ def index(request, year_num, month_num):
     this_time = timezone.now()
     this_day, this_month, this_year = this_time.day, this_time.month, this_time.year
 
-    requested_expenses = Expense.objects.filter(payment_time__month=month_num,
-                                                payment_time__year=year_num)
+    requested_expenses = Expense.objects.in_month(year_num, month_num).cards()
 
-    paginator = Paginator(requested_expenses, 6)
+    paginator = Paginator(requested_expenses, CARDS_PER_PAGE)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
-
-    requested_monthly_expense = sum(
-        [expense.amount for expense in requested_expenses])
+    next_cursor = card_cursor(page_obj[-1]) if page_obj.has_next() else None
 
     show_add_button = False
 
@@ -62,32 +128,13 @@ def index(request, year_num, month_num):
 
     prev = {'month': prev_exp_month, 'year': prev_exp_year}
 
-    last_monthly_expense = Expense.objects.filter(
-        payment_time__month=prev_exp_month,
-        payment_time__year=prev_exp_year).aggregate(
-            Sum('amount'))['amount__sum']
+    totals = stats.month_totals((year_num, month_num),
+                                (prev_exp_year, prev_exp_month))
+    requested_monthly_expense = totals[year_num, month_num]
+    last_monthly_expense = totals[prev_exp_year, prev_exp_month]
 
-    if not last_monthly_expense:
-        last_monthly_expense = 0
-
-    progress = {}
-    progress['color'] = {}
-    if requested_monthly_expense > last_monthly_expense:
-        progress['color']['bg'] = 'expended'
-        progress['color']['text'] = 'light'
-        progress['tail'] = 'more than'
-    elif requested_monthly_expense < last_monthly_expense:
-        progress['color']['bg'] = 'saved'
-        progress['color']['text'] = 'dark'
-        progress['tail'] = 'less than'
-    else:
-        progress['color']['bg'] = 'same'
-        progress['color']['text'] = 'light'
-        progress['tail'] = 'Same as'
-
-    progress['tail'] += ' last month'
-    progress['difference'] = abs(requested_monthly_expense -
-                                 last_monthly_expense)
+    progress = compare_spending(requested_monthly_expense,
+                                last_monthly_expense, 'last month')
 
     data = {
         # 'expenses': curr_expenses,
@@ -97,11 +144,42 @@ def index(request, year_num, month_num):
         'progress': progress,
         'show_add_button': show_add_button,
         'captured_date': captured_date,
-        'page_obj': page_obj
+        'page_obj': page_obj,
+        'next_cursor': next_cursor,
     }
     return render(request, 'expenses/index.html', context=data)
 
 
+def expense_cards(request, year_num, month_num):
+    """
+    Just the card grid of the next page of a month, for the index page to
+    append in place. Pages are addressed by the cursor of their preceding
+    card, so a page costs one indexed range query and no count.
+    """
+    expenses = Expense.objects.in_month(year_num, month_num)
+
+    if request.GET.get('after'):
+        try:
+            expenses = expenses.listed_after(
+                *parse_cursor(request.GET['after']))
+        except (ValueError, OverflowError):
+            return HttpResponseBadRequest('Invalid cursor')
+
+    cards = list(expenses.cards()[:CARDS_PER_PAGE + 1])
+    next_cursor = None
+    if len(cards) > CARDS_PER_PAGE:
+        cards = cards[:CARDS_PER_PAGE]
+        next_cursor = card_cursor(cards[-1])
+
+    return render(
+        request, 'expenses/expense_cards.html', {
+            'expenses': cards,
+            'next_cursor': next_cursor,
+            'year': year_num,
+            'month': month_num,
+        })
+
+
 def detail(request, expense_id):
     expense_object = get_object_or_404(Expense, id=expense_id)
     data = {'expense': expense_object}
@@ -112,14 +190,22 @@ def add_expense(request):
     if request.method == 'POST':
         title = request.POST.get('title')
         desc = request.POST.get('desc')
-        price = float(request.POST.get('price'))
+
+        try:
+            price = parse_amount(request.POST.get('price'))
+        except (TypeError, ValueError):
+            messages.add_message(request,
+                                 level=messages.ERROR,
+                                 message='Please enter a valid amount!',
+                                 extra_tags='safe')
+            return HttpResponseRedirect(reverse('expenses:add'))
 
         new_expense = Expense(title=title,
                               description=desc,
                               amount=price,
                               payment_time=timezone.now())
 
-        new_expense.save()
+        save_expense(new_expense)
 
         messages.add_message(request,
                              level=SUCCESS,
@@ -137,7 +223,8 @@ def delete_expense(request, expense_id):
         expense_time = expense.payment_time
         month, year = expense_time.month, expense_time.year
 
-        expense.delete()
+        with transaction.atomic():
+            expense.delete()
 
         messages.add_message(
             request,
@@ -167,14 +254,54 @@ def update_expense(request, expense_id):
         expense_time = expense.payment_time
         year, month = expense_time.year, expense_time.month
 
+        changes = {}
         if title:
-            expense.title = title
+            changes['title'] = title
         if description:
-            expense.description = description
-        if amount:
-            expense.amount = amount
-
-        expense.save()
+            changes['description'] = description
+        try:
+            if amount:
+                changes['amount'] = parse_amount(amount)
+        except ValueError:
+            messages.add_message(request,
+                                 level=messages.ERROR,
+                                 message='Please enter a valid amount!',
+                                 extra_tags='safe')
+            return HttpResponseRedirect(
+                reverse('expenses:update', args=(expense_id, )))
+
+        try:
+            # the version the form was rendered with, if it sent one
+            version = int(request.POST.get('version', expense.version))
+        except ValueError:
+            messages.add_message(
+                request,
+                level=messages.ERROR,
+                message='The form was <b>out of date</b>, please reload it '
+                'and try again!',
+                extra_tags='safe')
+            return HttpResponseRedirect(
+                reverse('expenses:update', args=(expense_id, )))
+
+        # only applies if nobody else saved the expense since it was read
+        with transaction.atomic():
+            updated = Expense.objects.filter(id=expense_id,
+                                             version=version).update(
+                                                 version=F('version') + 1,
+                                                 **changes)
+            if updated and 'amount' in changes:
+                stats.expense_changed(expense_id, expense_time,
+                                      expense.amount, changes['amount'])
+
+        if not updated:
+            messages.add_message(
+                request,
+                level=messages.ERROR,
+                message='This expense was <b>changed</b> by someone else in '
+                'the meantime, please review it and try again!',
+                extra_tags='safe')
+            return HttpResponseRedirect(
+                reverse('expenses:update', args=(expense_id, )))
 
         messages.add_message(
             request,
@@ -199,19 +326,9 @@ def monthly_chart(request, year_num, month_num):
     labels = []
     data = []
 
-    expenses_list = Expense.objects.values('payment_time__day')\
-        .order_by('payment_time__day')\
-        .annotate(total_expenses=Sum('amount'))\
-        .filter(
-            payment_time__month=month_num,
-            payment_time__year=year_num
-        )
-
-    for expense in expenses_list:
-        expense_day = expense.get('payment_time__day')
-        expense_date = datetime(year=year_num, month=month_num, day=expense_day)
-        labels.append(expense_date)
-        data.append(expense.get('total_expenses'))
+    for day, total in stats.month_days(year_num, month_num):
+        labels.append(datetime(year=year_num, month=month_num, day=day))
+        data.append(total)
 
     return render(
         request, 'expenses/month_chart.html', {
@@ -223,12 +340,12 @@ def monthly_chart(request, year_num, month_num):
 
 def delete_expenses_monthly(request, year_num, month_num):
     if request.method == 'POST':
-        expenses = get_list_or_404(Expense,
-                                   payment_time__month=month_num,
-                                   payment_time__year=year_num)
+        expenses = get_list_or_404(
+            Expense.objects.in_month(year_num, month_num))
 
-        for expense in expenses:
-            expense.delete()
+        with transaction.atomic():
+            for expense in expenses:
+                expense.delete()
 
         messages.add_message(
             request,
@@ -248,3 +365,253 @@ def delete_expenses_monthly(request, year_num, month_num):
 
         return HttpResponseRedirect(
             reverse('expenses:index', args=(year_num, month_num)))
+
+
+def year_dashboard(request, year_num):
+    monthly_stats = {
+        (stat.year, stat.month): stat
+        for stat in MonthlyStat.objects.filter(year__in=(year_num - 1,
+                                                         year_num))
+    }
+
+    months = []
+    for month_num in range(1, 13):
+        stat = monthly_stats.get((year_num, month_num))
+        months.append({
+            'date': date(year=year_num, month=month_num, day=1),
+            'total': stat.total if stat else 0,
+            'count': stat.count if stat else 0,
+        })
+
+    yearly_expense = sum(month['total'] for month in months)
+    last_yearly_expense = sum(stat.total
+                              for (year, _), stat in monthly_stats.items()
+                              if year == year_num - 1)
+
+    sketch = stats.merged_sketch(stat for (year, _), stat in
+                                 monthly_stats.items() if year == year_num)
+
+    spent_months = [month for month in months if month['count']]
+    highest = max(spent_months, key=lambda month: month['total'], default=None)
+    lowest = min(spent_months, key=lambda month: month['total'], default=None)
+    average = yearly_expense / len(spent_months) if spent_months else 0
+
+    largest_expenses = stats.largest_expenses(
+        stat for (year, _), stat in monthly_stats.items() if year == year_num)
+
+    return render(
+        request, 'expenses/year_dashboard.html', {
+            'year': year_num,
+            'months': months,
+            'yearly_expense': yearly_expense,
+            'last_yearly_expense': last_yearly_expense,
+            'progress': compare_spending(yearly_expense, last_yearly_expense,
+                                         'last year'),
+            'highest': highest,
+            'lowest': lowest,
+            'average': average,
+            'median': sketch.quantile(0.5),
+            'p95': sketch.quantile(0.95),
+            'largest_expenses': largest_expenses,
+        })
+
+
+def monthly_distribution(request, year_num, month_num):
+    try:
+        span = min(max(int(request.GET.get('months', 1)), 1), 120)
+    except ValueError:
+        span = 1
+
+    # `span` months ending with the requested one
+    first = year_num * 12 + month_num - span
+    start, end = (first // 12, first % 12 + 1), (year_num, month_num)
+
+    sketch = stats.merged_sketch(
+        MonthlyStat.objects.filter(stats.months_between(start, end)))
+
+    percentiles = [{
+        'rank': rank,
+        'amount': sketch.quantile(rank / 100)
+    } for rank in (25, 50, 75, 90, 95, 99)]
+
+    histogram = sketch.histogram(10)
+
+    return render(
+        request, 'expenses/distribution.html', {
+            'count': sketch.count,
+            'percentiles': percentiles,
+            'labels': ['%d - %d' % (low, high) for low, high, _ in histogram],
+            'data': [count for _, _, count in histogram],
+            'span': span,
+            'spans': (1, 3, 6, 12),
+            'start_date': datetime(year=start[0], month=start[1], day=1),
+            'req_date': datetime(year=year_num, month=month_num, day=1)
+        })
+
+
+def parse_batch_item(item):
+    """
+    Unsaved Expense for one item of an API batch, or a dict of errors.
+    """
+    if not isinstance(item, dict):
+        return None, {'item': 'Must be an object.'}
+
+    errors = {}
+    key = item.get('idempotency_key')
+    if not isinstance(key, str) or not 0 < len(key) <= 64:
+        errors['idempotency_key'] = 'Required, at most 64 characters.'
+
+    title = item.get('title')
+    if not isinstance(title, str) or not 0 < len(title) <= 100:
+        errors['title'] = 'Required, at most 100 characters.'
+
+    description = item.get('description', '')
+    if not isinstance(description, str) or len(description) > 200:
+        errors['description'] = 'At most 200 characters.'
+
+    amount = None
+    try:
+        if isinstance(item.get('amount'), bool):
+            raise ValueError
+        amount = parse_amount(item.get('amount'))
+    except (TypeError, ValueError):
+        errors['amount'] = 'Required, a non-negative number.'
+
+    payment_time = timezone.now()
+    if item.get('payment_time') is not None:
+        try:
+            payment_time = parse_datetime(item['payment_time'])
+        except (TypeError, ValueError):
+            payment_time = None
+        if payment_time is None:
+            errors['payment_time'] = 'An ISO 8601 date and time.'
+        elif timezone.is_naive(payment_time):
+            payment_time = timezone.make_aware(payment_time)
+
+    if errors:
+        return None, errors
+
+    return Expense(title=title,
+                   description=description,
+                   amount=amount,
+                   payment_time=payment_time,
+                   idempotency_key=key), None
+
+
+def insert_batch(expenses):
+    """
+    Insert the expenses whose idempotency key is not taken yet, all in one
+    transaction. Returns {key: (id, created)} for every key of the batch.
+    """
+    keys = [expense.idempotency_key for expense in expenses]
+
+    with transaction.atomic():
+        existing = dict(
+            Expense.objects.filter(idempotency_key__in=keys).values_list(
+                'idempotency_key', 'id'))
+
+        new_expenses = []
+        for expense in expenses:
+            if expense.idempotency_key not in existing:
+                existing[expense.idempotency_key] = None
+                new_expenses.append(expense)
+
+        Expense.objects.bulk_create(new_expenses)
+
+        created = dict(
+            Expense.objects.filter(idempotency_key__in=[
+                expense.idempotency_key for expense in new_expenses
+            ]).values_list('idempotency_key', 'id'))
+        # SQLite does not hand the new ids back to bulk_create
+        for expense in new_expenses:
+            expense.pk = created[expense.idempotency_key]
+        stats.expenses_added(new_expenses)
+
+    return {
+        key: (created[key], True) if expense_id is None else
+        (expense_id, False)
+        for key, expense_id in existing.items()
+    }
+
+
+@csrf_exempt
+@require_POST
+def api_add_expenses(request):
+    """
+    Add many expenses in one request, for the mobile app and bank sync.
+
+    Every item carries a client chosen `idempotency_key`; items whose key
+    was already used are reported as duplicates instead of being added
+    again, so a whole batch can safely be retried.
+
+    The view is exempt from CSRF protection, so it only accepts JSON: a
+    browser cannot send that cross-site without a CORS preflight, unlike
+    a plain form post. The bearer token of EXPENSE_API_TOKEN is required
+    when it is set.
+    """
+    if settings.EXPENSE_API_TOKEN and not hmac.compare_digest(
+            request.META.get('HTTP_AUTHORIZATION', ''),
+            'Bearer ' + settings.EXPENSE_API_TOKEN):
+        return JsonResponse({'error': 'Invalid or missing API token.'},
+                            status=401)
+
+    if request.content_type != 'application/json':
+        return JsonResponse({'error': 'Expected application/json.'},
+                            status=415)
+
+    try:
+        items = json.loads(request.body)['expenses']
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': 'Expected {"expenses": [...]}.'},
+                            status=400)
+
+    if not isinstance(items, list):
+        return JsonResponse({'error': '"expenses" must be a list.'},
+                            status=400)
+    if len(items) > MAX_BATCH_SIZE:
+        return JsonResponse(
+            {'error': 'At most %d expenses per batch.' % MAX_BATCH_SIZE},
+            status=400)
+
+    parsed = [parse_batch_item(item) for item in items]
+    expenses = [expense for expense, _ in parsed if expense is not None]
+
+    for attempt in range(BATCH_ATTEMPTS):
+        try:
+            outcome = insert_batch(expenses)
+            break
+        except IntegrityError:
+            # a concurrent request took one of the keys, look again
+            if attempt == BATCH_ATTEMPTS - 1:
+                raise
+        except OperationalError:
+            # insert_batch reads before it writes: SQLite fails the upgrade
+            # to a write lock at once ("database is locked") instead of
+            # waiting while another batch writes, so back off and retry
+            if attempt == BATCH_ATTEMPTS - 1:
+                raise
+            time.sleep(0.05 * 2**attempt)
+
+    results = []
+    claimed = set()
+    for index, (expense, errors) in enumerate(parsed):
+        if expense is None:
+            results.append({
+                'index': index,
+                'status': 'invalid',
+                'errors': errors
+            })
+            continue
+
+        key = expense.idempotency_key
+        expense_id, created = outcome[key]
+        results.append({
+            'index': index,
+            'idempotency_key': key,
+            'status': 'created' if created and key not in claimed else
+            'duplicate',
+            'id': expense_id,
+        })
+        claimed.add(key)
+
+    return JsonResponse({'results': results})
@@ -0,0 +1,127 @@
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+
+class _Entry:
+    __slots__ = ('expense', 'done', 'lead', 'error')
+
+    def __init__(self, expense):
+        self.expense = expense
+        self.done = threading.Event()
+        self.lead = False
+        self.error = None
+
+
+class GroupCommitter:
+    """
+    Coalesces inserts coming from concurrent requests into one transaction.
+
+    The first request to arrive becomes the leader: it waits up to
+    ``max_delay`` seconds (or until ``max_batch`` expenses are queued),
+    saves the whole batch in a single transaction and wakes everybody up.
+    Each caller only returns once its expense is committed, so a redirect
+    issued afterwards always sees the new row.
+    """
+    def __init__(self, max_batch, max_delay):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._queue = []
+        self._leading = False
+
+    def submit(self, expense):
+        entry = _Entry(expense)
+
+        with self._cond:
+            self._queue.append(entry)
+            if self._leading:
+                self._cond.notify()
+            else:
+                self._leading = entry.lead = True
+
+        if not entry.lead:
+            entry.done.wait()
+            if not entry.lead:
+                if entry.error is not None:
+                    raise entry.error
+                return expense
+
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._queue) >= self.max_batch,
+                                timeout=self.max_delay)
+            batch = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+
+        self._flush(batch)
+
+        with self._cond:
+            if self._queue:
+                # whoever queued up meanwhile leads the next batch, so only
+                # one transaction at a time ever asks for the write lock
+                successor = self._queue[0]
+                successor.lead = True
+                successor.done.set()
+            else:
+                self._leading = False
+
+        for queued in batch:
+            if queued is not entry:
+                queued.done.set()
+
+        if entry.error is not None:
+            raise entry.error
+        return expense
+
+    def _flush(self, batch):
+        try:
+            with transaction.atomic():
+                for queued in batch:
+                    queued.expense.save()
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].error = error
+                return
+        else:
+            return
+
+        # one bad row must not fail everybody else's insert
+        for queued in batch:
+            queued.expense.pk = None
+            try:
+                # row and monthly statistics commit together or not at all
+                with transaction.atomic():
+                    queued.expense.save()
+            except Exception as error:
+                queued.error = error
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def get_committer():
+    global _committer
+
+    with _committer_lock:
+        if (_committer is None
+                or _committer.max_batch != settings.EXPENSE_WRITE_BATCH_SIZE
+                or _committer.max_delay != settings.EXPENSE_WRITE_BATCH_DELAY):
+            _committer = GroupCommitter(settings.EXPENSE_WRITE_BATCH_SIZE,
+                                        settings.EXPENSE_WRITE_BATCH_DELAY)
+        return _committer
+
+
+def save_expense(expense):
+    """
+    Insert a new expense, batched with concurrent inserts when
+    ``EXPENSE_WRITE_BATCHING`` is on. Returns once the row is committed.
+    """
+    if not settings.EXPENSE_WRITE_BATCHING:
+        # the monthly statistics are updated in the same transaction
+        with transaction.atomic():
+            expense.save()
+        return expense
+
+    return get_committer().submit(expense)